@@ -0,0 +1,420 @@
+import asyncio
+import copy
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, List
+
+import requests
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from aids.app.cache import ResponseCache, cacheable, default_cache
+from aids.app.client import (
+    AIDScrapper,
+    BatchNotSupported,
+    RetryPolicy,
+    log_http_error,
+)
+from aids.app.records import Record
+from aids.app.throttle import RateLimiter, rate_limiter
+from aids.app.writelogs import logged
+from aids.app import settings
+
+
+def async_check_errors(request):
+    """check_errors for coroutines. Same retry policy, but the waiting is
+    done with asyncio.sleep so the other requests keep going."""
+
+    async def inner_func(cls, method, url, idempotent=True, **kwargs):
+        policy = cls.retry_policy
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await request(cls, method, url, **kwargs)
+                response.raise_for_status()
+            except httpx.TransportError as exc:
+                cls.logger_err.exception(exc)
+                cls.logger_err.error(
+                    "Server URL: %s, failed while trying to connect.", url
+                )
+                # the request may have been sent, unless it did not connect
+                if (
+                    not idempotent
+                    and not isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+                ) or (delay := policy.delay(attempt, started)) is None:
+                    policy.record_failure()
+                    cls.logger.error("Giving up after %d attempts.", attempt)
+                    raise
+                cls.logger.info("Network unstable. Retrying in %.1fs...", delay)
+            except httpx.HTTPStatusError as exc:
+                if response.status_code == 429:
+                    cls.rate_limiter.throttled(url)
+                if policy.should_retry(response.status_code, idempotent) and (
+                    (delay := policy.delay(attempt, started, response)) is not None
+                ):
+                    cls.logger.info(
+                        "Server busy (%d). Retrying in %.1fs...",
+                        response.status_code,
+                        delay,
+                    )
+                else:
+                    if response.status_code in policy.statuses:
+                        policy.record_failure()
+                    log_http_error(cls, response, kwargs.get("json", "none"))
+                    raise requests.exceptions.HTTPError(response=response) from exc
+            else:
+                cls.rate_limiter.succeeded(url)
+                return response
+            policy.record_retry()
+            await asyncio.sleep(delay)
+
+    return inner_func
+
+
+@logged
+class AsyncSession:
+    """
+    Minimal asyncio counterpart of Session on top of httpx. It shares the
+    rate limits of the process with the synchronous sessions.
+    """
+
+    def __init__(
+        self,
+        retry_policy: RetryPolicy = None,
+        limiter: RateLimiter = None,
+        pool_maxsize: int = settings.POOL_MAXSIZE,
+        cache: ResponseCache = None,
+    ):
+        if not httpx:
+            raise ImportError("You need the httpx library to use the async client.")
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = limiter or rate_limiter
+        if cache is None and settings.CACHE_ENABLED:
+            cache = default_cache()
+        self.cache = cache
+        # the callers bound how many requests are in flight, the pool only
+        # decides how many idle connections are kept alive between them
+        self.client = httpx.AsyncClient(
+            http2=settings.HTTP_BACKEND == "http2",
+            limits=httpx.Limits(
+                max_connections=None, max_keepalive_connections=pool_maxsize
+            ),
+            timeout=settings.REQUEST_TIMEOUT,
+        )
+
+    @property
+    def headers(self):
+        return self.client.headers
+
+    @headers.setter
+    def headers(self, headers):
+        self.client.headers = headers
+
+    @property
+    def cookies(self):
+        return self.client.cookies
+
+    async def request(
+        self,
+        method,
+        url,
+        cache=False,
+        updated_at=None,
+        expires=False,
+        idempotent=True,
+        **kwargs,
+    ):
+        """Same caching as Session.request. The cache is read and written in
+        a worker thread, not to block the event loop on the disk."""
+        if not (cache and self.cache):
+            return await self._request(method, url, idempotent=idempotent, **kwargs)
+
+        key = self.cache.key(url, kwargs.get("json"))
+        content = await asyncio.to_thread(self.cache.get, key, updated_at, expires)
+        if content is not None:
+            return httpx.Response(
+                200, content=content, request=httpx.Request(method, url)
+            )
+        response = await self._request(method, url, idempotent=idempotent, **kwargs)
+        if cacheable(response):
+            await asyncio.to_thread(self.cache.set, key, response.content, updated_at)
+        return response
+
+    @async_check_errors
+    async def _request(self, method, url, **kwargs):
+        delay = self.rate_limiter.delay(url)
+        if delay:
+            await asyncio.sleep(delay)
+        return await self.client.request(method, url, **kwargs)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def close(self):
+        # the connections can only be closed from the event loop, see aclose
+        pass
+
+
+class AsyncAIDScrapper(AIDScrapper):
+    """
+    asyncio version of AIDScrapper. It has the same public methods but they
+    are coroutines. Up to self.workers requests are in flight at the same time.
+
+        async with AsyncAIDScrapper() as client:
+            await client.login()
+            await client.get_stories()
+    """
+
+    def __init__(self):
+        super().__init__()
+        # drop the blocking session
+        self.session.close()
+        self.session = AsyncSession(
+            pool_maxsize=max(self.workers, settings.POOL_MAXSIZE)
+        )
+        self.session.headers.update(settings.get_request_headers())
+
+    @property
+    def workers(self) -> int:
+        """How many requests are in flight at the same time."""
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers: int):
+        self._workers = workers
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.quit()
+
+    async def quit(self):
+        await self.session.aclose()
+
+    async def login(self, credentials=None):
+        credentials = self._credentials(credentials)
+
+        key = await self.get_login_token(credentials)
+
+        self.session.headers.update({"x-access-token": key})
+        self.logger.info(
+            'User "%s" sucessfully logged into AID', credentials["username"]
+        )
+
+    async def get_login_token(self, credentials: Dict[str, Any]):
+        res = await self.session.post(self.url, json=self._login_payload(credentials))
+        return self._login_token(res.json())
+
+    async def _get_story_content(self, story_id: str) -> Dict[str, Any]:
+        query = {**self.story_query, "variables": {"publicId": story_id}}
+        res = await self.session.post(
+            self.url, json=query, cache=True, updated_at=self.updated_at.get(story_id)
+        )
+        return res.json()["data"]["adventure"]
+
+    async def _get_scenario_content(
+        self, scenario_id: str, parent_updated_at: str = None
+    ) -> Dict[str, Any]:
+        updated_at, expires = self._revalidation(scenario_id, parent_updated_at)
+        scenario_query = {**self.scenario_query, "variables": {"publicId": scenario_id}}
+        if self.batch_queries:
+            try:
+                scenario_res, wi_res = await self._post_batch(
+                    [scenario_query, self._wi_payload(scenario_id)],
+                    updated_at,
+                    expires,
+                )
+                scenario = scenario_res["data"]["scenario"]
+                scenario.update({"worldInfo": wi_res["data"]["worldInfoType"]})
+                return scenario
+            except (
+                requests.exceptions.HTTPError,
+                ValueError,
+                KeyError,
+                TypeError,
+            ) as exc:
+                self._batch_failed(scenario_id, exc)
+
+        # no batching, but both are in flight at the same time
+        wi, scenario_res = await asyncio.gather(
+            self._get_wi(scenario_id, updated_at, expires),
+            self.session.post(
+                self.url,
+                json=scenario_query,
+                cache=True,
+                updated_at=updated_at,
+                expires=expires,
+            ),
+        )
+        scenario = scenario_res.json()["data"]["scenario"]
+        scenario.update({"worldInfo": wi})
+        return scenario
+
+    async def _post_batch(
+        self,
+        queries: List[Dict[str, Any]],
+        updated_at: str = None,
+        expires: bool = False,
+    ) -> List[Dict[str, Any]]:
+        res = await self.session.post(
+            self.url,
+            json=queries,
+            cache=True,
+            updated_at=updated_at,
+            expires=expires,
+        )
+        results = res.json()
+        if not isinstance(results, list) or len(results) != len(queries):
+            raise BatchNotSupported(
+                "The server did not answer with one result per query"
+            )
+        return results
+
+    async def _get_wi(
+        self, scenario_id: str, updated_at: str = None, expires: bool = False
+    ) -> Dict[str, Any]:
+        res = await self.session.post(
+            self.url,
+            json=self._wi_payload(scenario_id),
+            cache=True,
+            updated_at=updated_at,
+            expires=expires,
+        )
+        return res.json()["data"]["worldInfoType"]
+
+    async def _query_objects(self, query: dict, term: str = "") -> Dict[str, Any]:
+        query["variables"]["input"]["searchTerm"] = (
+            term or self.adventures.title or self.prompts.title
+        )
+
+        res = await self.session.post(self.url, json=query)
+        return res.json()["data"]["user"]["search"]
+
+    async def _pages(
+        self, query: Dict[str, Any]
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Same as AIDScrapper._pages: the next page is requested while the
+        caller is busy with the current one."""
+        query = copy.deepcopy(query)
+        query["variables"]["input"]["offset"] = offset = 0
+
+        next_page = asyncio.ensure_future(self._query_objects(query))
+        try:
+            while True:
+                result = list(await next_page)
+                if not result:
+                    return
+                self._remember_updates(result)
+                offset += len(result)
+                query["variables"]["input"]["offset"] = offset
+                next_page = asyncio.ensure_future(self._query_objects(query))
+
+                yield result
+        finally:
+            next_page.cancel()
+
+    @staticmethod
+    async def _bounded(semaphore: asyncio.Semaphore, coro):
+        async with semaphore:
+            return await coro
+
+    async def get_stories(self):
+        semaphore = asyncio.Semaphore(self.workers)
+        pages = self._pages(self.stories_query)
+        try:
+            async for result in pages:
+                result = [story for story in result if not self._in_sync(story)]
+                tasks = [
+                    asyncio.ensure_future(
+                        self._bounded(
+                            semaphore, self._get_story_content(story["publicId"])
+                        )
+                    )
+                    for story in result
+                ]
+                for story, task in zip(result, tasks):
+                    # the checkpoint writes to the disk, not on the event loop
+                    if not await asyncio.to_thread(self._add_story, story, await task):
+                        for pending in tasks:
+                            pending.cancel()
+                        return
+                self.logger.debug("Got %d stories so far", len(self.adventures))
+            self.logger.info("All stories downloaded")
+        finally:
+            await pages.aclose()
+
+    async def get_scenarios(self):
+        pages = self._pages(self.scenarios_query)
+        try:
+            async for result in pages:
+                for scenario in result:
+                    if self._in_sync(scenario):
+                        continue
+                    self._forget(self.prompts, scenario["publicId"])
+                    await self.add_all_scenarios(scenario["publicId"])
+                self.logger.debug("Got %d scenarios so far", len(self.prompts))
+        finally:
+            await pages.aclose()
+        self.logger.info("All scenarios downloaded")
+
+    async def add_all_scenarios(self, pubid, isOption=False):
+        """Same crawl as AIDScrapper.add_all_scenarios, with each batch of
+        options fetched concurrently on the event loop."""
+        crawl = await asyncio.to_thread(self._new_crawl, pubid, isOption)
+        frontier = deque(crawl["frontier"])
+        visited = set(crawl["visited"])
+        scenarios = crawl["scenarios"]
+
+        while frontier:
+            batch = [
+                frontier.popleft() for _ in range(min(self.workers, len(frontier)))
+            ]
+            fetched = await asyncio.gather(
+                *(
+                    self._get_scenario_content(node[0], self._parent_updated_at(node))
+                    for node in batch
+                )
+            )
+            for node, scenario in zip(batch, fetched):
+                self._expand(node, scenario, frontier, visited)
+                scenarios.append(scenario)
+            # not to block the event loop on the disk
+            await asyncio.to_thread(
+                self._save_crawl, pubid, frontier, visited, scenarios[-len(batch) :]
+            )
+
+        await asyncio.to_thread(self._add_crawled, pubid, scenarios)
+
+    async def upload_in_bulk(self, scenarios: Dict[str, Any]):
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def upload(scenario):
+            if isinstance(scenario, Record):
+                scenario = scenario.to_dict()
+            assert isinstance(scenario, dict)
+
+            # sent twice, it would create two scenarios
+            res = await self.session.post(
+                self.url, json=self.create_scen_payload, idempotent=False
+            )
+            new_scenario = self._update_payload(
+                scenario, res.json()["data"]["createScenario"]["publicId"]
+            )
+            await self.session.post(self.url, json=new_scenario)
+            self.logger.info("%s successfully uploaded...", scenario["title"])
+
+        await asyncio.gather(
+            *(self._bounded(semaphore, upload(scenarios[key])) for key in scenarios)
+        )
@@ -0,0 +1,252 @@
+"""
+Backups of the archives, made on every dump. Each backup is stored by the
+hash of its content, so an archive that did not change since the last backup
+takes no space (and no writing) at all:
+
+    backups/
+        index.json                  name, time and hash of every backup
+        objects/<sha256>.json[.gz]  the contents, one file per distinct one
+
+Only the newest backups of each archive are kept, see BACKUP_KEEP and
+BACKUP_MAX_AGE in the settings, and the contents no backup refers to are
+removed. An archive whose file did not change since its last backup is not
+even read again.
+
+The full copies left in backups/ by older versions (story_<uuid>.json...) are
+moved into the store as backups of story.json (...), under the same rules.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from aids.app.writelogs import logged
+from aids.app import settings
+
+# the index is shared by all the containers of the process
+_lock = threading.Lock()
+# <model>_<uuid><suffix>, the backups made before the store
+LEGACY_BACKUP = re.compile(
+    r"([a-z]+)_[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+    r"(\.[a-z]+)"
+)
+
+
+def file_hash(path: Union[str, Path], chunk_size: int = 2**20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_state(path: Union[str, Path]) -> Optional[List[int]]:
+    """What tells that the file changed, short of reading it: the archives
+    are replaced when they are saved, or written in place and then grow."""
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, TypeError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+@logged
+class BackupStore:
+    """
+    The backups in `directory`, see the module documentation. Anything with
+    a `backup(target)` method that copies the archive to target -- the
+    storages of aids.app.storage -- can be backed up:
+
+        backups = BackupStore()
+        backups.add(stories.storage, "/home/me/story.json")
+        backups.restore("/home/me/story.json", "story.json")
+
+    The archives dumped by the models are backed up by their absolute path.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path] = settings.BACKUP_DIR,
+        keep: int = settings.BACKUP_KEEP,
+        max_age: Optional[float] = settings.BACKUP_MAX_AGE,
+        compress: bool = settings.BACKUP_COMPRESS,
+    ):
+        self.directory = Path(directory)
+        self.objects_dir = self.directory / "objects"
+        self.index_path = self.directory / "index.json"
+        # the newest backup is always kept
+        self.keep = max(keep, 1)
+        self.max_age = max_age
+        self.compress = compress
+
+    # --- index ---
+    def _read_index(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.index_path) as file:
+                return json.load(file)["backups"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return []
+
+    def _write_index(self, backups: List[Dict[str, Any]]):
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump({"backups": backups}, file, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def backups(self, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """The backups of the archive called `name` (of all of them if None),
+        newest first."""
+        with _lock:
+            backups = self._read_index()
+        return [backup for backup in backups if name is None or backup["name"] == name]
+
+    # --- contents ---
+    def _content(self, backup: Dict[str, Any]) -> Optional[Path]:
+        for path in (
+            self.objects_dir / f"{backup['hash']}{backup['suffix']}",
+            self.objects_dir / f"{backup['hash']}{backup['suffix']}.gz",
+        ):
+            if path.exists():
+                return path
+        return None
+
+    def _store(self, tmp_path: Path, digest: str, suffix: str):
+        target = self.objects_dir / f"{digest}{suffix}"
+        if not self.compress:
+            os.replace(tmp_path, target)
+            return
+        target = target.with_name(target.name + ".gz")
+        tmp_target = self.objects_dir / f".{uuid.uuid4().hex}.tmp.gz"
+        try:
+            with open(tmp_path, "rb") as source, gzip.open(tmp_target, "wb") as zipped:
+                shutil.copyfileobj(source, zipped)
+            os.replace(tmp_target, target)
+        finally:
+            if tmp_target.exists():
+                os.remove(tmp_target)
+
+    def _retained(self, backups: List[Dict[str, Any]], now: float):
+        seen: Counter = Counter()
+        for backup in backups:
+            seen[backup["name"]] += 1
+            if seen[backup["name"]] == 1 or (
+                seen[backup["name"]] <= self.keep
+                and (self.max_age is None or now - backup["time"] <= self.max_age)
+            ):
+                yield backup
+
+    def _adopt_legacy(self, backups: List[Dict[str, Any]]):
+        """Move the backups of older versions into the store."""
+        adopted = False
+        for path in self.directory.iterdir():
+            match = LEGACY_BACKUP.fullmatch(path.name)
+            if not (match and path.is_file()):
+                continue
+            model, suffix = match.groups()
+            backup = {
+                "name": f"{model}{suffix}",
+                "time": path.stat().st_mtime,
+                "hash": file_hash(path),
+                "suffix": suffix,
+            }
+            if not self._content(backup):
+                self._store(path, backup["hash"], suffix)
+            if path.exists():
+                os.remove(path)
+            backups.append(backup)
+            adopted = True
+        if adopted:
+            backups.sort(key=lambda backup: backup["time"], reverse=True)
+            self.logger.info("Moved the backups of older versions into the store")
+
+    def _collect(self, backups: List[Dict[str, Any]]):
+        """Remove the contents no backup refers to."""
+        used = {backup["hash"] for backup in backups}
+        for path in self.objects_dir.iterdir():
+            if not path.name.startswith(".") and path.name[:64] not in used:
+                os.remove(path)
+
+    def _latest(self, backups: List[Dict[str, Any]], name: str):
+        return next((old for old in backups if old["name"] == name), None)
+
+    def _save(self, backups: List[Dict[str, Any]], backup: Dict[str, Any], now):
+        """Make backup the newest one, then apply the retention rules."""
+        self._adopt_legacy(backups)
+        backups.insert(0, backup)
+        backups = list(self._retained(backups, now))
+        self._write_index(backups)
+        self._collect(backups)
+
+    def add(self, storage, name: str) -> Dict[str, Any]:
+        """Back up the archive of `storage` as `name`, then remove the backups
+        that are too many or too old."""
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        suffix = getattr(storage, "suffix", "")
+        # taken before the copy: if the file changes meanwhile, it is copied
+        # again next time
+        state = archive_state(getattr(storage, "path", None))
+        with _lock:
+            backups = self._read_index()
+            latest = self._latest(backups, name)
+            if (
+                state is not None
+                and latest
+                and latest.get("state") == state
+                and self._content(latest)
+            ):
+                # the file was not touched, the same backup is just newer
+                backups.remove(latest)
+                now = time.time()
+                backup = {**latest, "time": now}
+                self._save(backups, backup, now)
+                return backup
+
+        tmp_path = self.objects_dir / f".{uuid.uuid4().hex}.tmp{suffix}"
+        try:
+            storage.backup(tmp_path)
+            digest = file_hash(tmp_path)
+            with _lock:
+                backups = self._read_index()
+                now = time.time()
+                backup = {
+                    "name": name,
+                    "time": now,
+                    "hash": digest,
+                    "suffix": suffix,
+                    "state": state,
+                }
+                latest = self._latest(backups, name)
+                if latest and latest["hash"] == digest:
+                    # nothing changed, the same backup is just newer
+                    backups.remove(latest)
+                if not self._content(backup):
+                    self._store(tmp_path, digest, suffix)
+                    self.logger.info("New backup of %s: %s", name, digest)
+                self._save(backups, backup, now)
+        finally:
+            if tmp_path.exists():
+                os.remove(tmp_path)
+        return backup
+
+    def restore(
+        self, name: str, target: Union[str, Path], number: int = 0
+    ) -> Dict[str, Any]:
+        """Copy a backup of `name` to target: the newest one, or the one
+        `number` backups older."""
+        backup = self.backups(name)[number]
+        path = self._content(backup)
+        if path is None:
+            raise FileNotFoundError(f"The content of the backup {backup} is missing")
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rb") as source, open(target, "wb") as copy:
+            shutil.copyfileobj(source, copy)
+        return backup
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import requests
+
+from aids.app.writelogs import logged
+from aids.app import settings
+
+
+@logged
+class ResponseCache:
+    """
+    Response bodies saved on disk, keyed by a hash of the url and the GraphQL
+    query and variables. Entries expire after `ttl` seconds unless they are
+    revalidated by `updatedAt`: then they are valid for as long as the object
+    was not updated. The least recently used entries are evicted when the
+    cache grows over `max_size` bytes.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path] = settings.CACHE_DIR,
+        ttl: float = settings.CACHE_TTL,
+        max_size: int = settings.CACHE_MAX_SIZE,
+    ):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        return (
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".json")
+        )
+
+    @staticmethod
+    def key(url: str, payload: Any) -> str:
+        """Hash of the url plus the query text and variables (of every
+        operation if it is a batch)."""
+        operations = payload if isinstance(payload, list) else [payload]
+        raw = json.dumps(
+            [url]
+            + [
+                [operation.get("query"), operation.get("variables")]
+                for operation in operations
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(
+        self, key: str, updated_at: str = None, expires: bool = False
+    ) -> Optional[bytes]:
+        """The cached content, if it is fresh: stored with the same updated_at
+        or, without one, younger than the ttl. With expires, a revalidated
+        entry must be younger than the ttl too -- for when updated_at is the
+        updatedAt of another object, such as the parent of an option."""
+        path = self.directory / f"{key}.json"
+        try:
+            with open(path) as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        fresh = True
+        if updated_at is not None:
+            fresh = entry["updatedAt"] == updated_at
+        if updated_at is None or expires:
+            fresh = fresh and time.time() - entry["stored"] < self.ttl
+        if not fresh:
+            self.misses += 1
+            return None
+
+        # the modification time is the "last used" mark of the LRU
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return entry["content"].encode()
+
+    def set(self, key: str, content: bytes, updated_at: str = None):
+        path = self.directory / f"{key}.json"
+        raw = json.dumps(
+            {
+                "stored": time.time(),
+                "updatedAt": updated_at,
+                "content": content.decode("utf-8"),
+            }
+        )
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w") as file:
+            file.write(raw)
+        with self._lock:
+            try:
+                self.size -= path.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self.size += len(raw)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is 90% full."""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.size -= size
+        self.logger.debug("Cache evicted down to %d bytes", self.size)
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries():
+                os.remove(entry.path)
+            self.size = 0
+
+
+def cacheable(response) -> bool:
+    """Only complete answers are worth keeping -- GraphQL reports its errors
+    with a 200 status code."""
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    results = body if isinstance(body, list) else [body]
+    return all(
+        isinstance(result, dict) and "data" in result and "errors" not in result
+        for result in results
+    )
+
+
+def cached_response(url: str, content: bytes) -> requests.Response:
+    """Build the response a cache hit stands for."""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = "utf-8"
+    response.headers["content-type"] = "application/json"
+    response._content = content
+    return response
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache() -> ResponseCache:
+    """The cache shared by every session of the process."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
@@ -1,7 +1,16 @@
 import warnings
 import json
 import getpass
-from typing import Sequence, List, Dict, Any
+from typing import Sequence, List, Dict, Any, Iterator, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from email.utils import parsedate_to_datetime
+import datetime
+import copy
+import os
+import random
+import threading
 import time
 import requests
 
@@ -16,14 +25,120 @@ except ImportError:
     stem = None
 
 from aids.app.models import Story, Scenario, ValidationError
+from aids.app.records import Record
 from aids.app.writelogs import logged
+from aids.app.cache import ResponseCache, cacheable, cached_response, default_cache
+from aids.app.throttle import RateLimiter, rate_limiter
+from aids.app.transport import Transport, transport as default_transport
 from aids.app import settings, schemes
 
 
+class RetryPolicy:
+    """
+    Decides if a failed request should be sent again and how long to wait
+    before doing it. Exponential backoff with full jitter, capped by a number
+    of attempts and by the time spent on the request since the first try.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = settings.RETRY_MAX_ATTEMPTS,
+        backoff: float = settings.RETRY_BACKOFF,
+        max_backoff: float = settings.RETRY_MAX_BACKOFF,
+        budget: float = settings.RETRY_BUDGET,
+        jitter: bool = True,
+        statuses: Sequence[int] = settings.RETRY_STATUSES,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.jitter = jitter
+        self.statuses = statuses
+
+        # counters -- shared by all the threads using the session
+        self.retries = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def delay(
+        self, attempt: int, started: float, response: requests.Response = None
+    ) -> Optional[float]:
+        """Seconds to wait before the next attempt or None to give up."""
+        if attempt >= self.max_attempts:
+            return None
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            # the server knows better
+            delay = max(delay, retry_after)
+        if time.monotonic() - started + delay > self.budget:
+            return None
+        return delay
+
+    @staticmethod
+    def retry_after(response: requests.Response) -> Optional[float]:
+        """Parse the Retry-After header. It is either seconds or an HTTP date."""
+        if response is None or "Retry-After" not in response.headers:
+            return None
+        value = response.headers["Retry-After"]
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return max(0.0, (date - now).total_seconds())
+
+    def should_retry(self, status_code: int, idempotent: bool = True) -> bool:
+        """Whether a request that failed with that status is sent again. One
+        that is not idempotent -- a mutation creating something -- only is
+        when the server surely did not process it: on a 429."""
+        return status_code in self.statuses and (idempotent or status_code == 429)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+
+def log_http_error(cls, response, payload):
+    """Log everything we know about a request that failed for good."""
+    try:
+        errors = response.json()["errors"]
+    except json.decoder.JSONDecodeError:
+        errors = "No errors"
+    except KeyError:
+        #
+        errors = response.json()
+    raw_response = (
+        response.content[:50] if len(response.content) > 50 else response.content
+    )
+    error_message = f"""
+        Server URL: {response.url}, 
+        failed with status code ({response.status_code}).
+        Errors: {errors}. 
+        Raw response: {raw_response} 
+        Request payload: {payload}
+    """
+    cls.logger.error(error_message)
+
+
 def check_errors(request):
-    def inner_func(cls, method, url, **kwargs):
-        request_success = False
-        while not request_success:
+    def inner_func(cls, method, url, idempotent=True, **kwargs):
+        policy = cls.retry_policy
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
             try:
                 response = request(cls, method, url, **kwargs)
                 response.raise_for_status()
@@ -32,45 +147,59 @@ def check_errors(request):
                 requests.exceptions.SSLError,
             ) as exc:
                 cls.logger_err.exception(exc)
-
-                cls.logger.info("Network unstable. Retrying...")
                 cls.logger_err.error(
                     "Server URL: %s, failed while trying to connect.", url
                 )
+                # the request may have been sent, unless it did not connect
+                if (
+                    not idempotent
+                    and not isinstance(exc, requests.exceptions.ConnectTimeout)
+                ) or (delay := policy.delay(attempt, started)) is None:
+                    policy.record_failure()
+                    cls.logger.error("Giving up after %d attempts.", attempt)
+                    raise
+                cls.logger.info("Network unstable. Retrying in %.1fs...", delay)
             except requests.exceptions.HTTPError as exc:
-                try:
-                    errors = response.json()["errors"]
-                except json.decoder.JSONDecodeError:
-                    errors = "No errors"
-                except KeyError:
-                    #
-                    errors = response.json()
-                raw_response = (
-                    response.content[:50]
-                    if len(response.content) > 50
-                    else response.content
-                )
-                try:
-                    payload = kwargs["data"]
-                except KeyError:
-                    payload = "none"
-                error_message = f"""
-                    Server URL: {response.url}, 
-                    failed with status code ({response.status_code}).
-                    Errors: {errors}. 
-                    Raw response: {raw_response} 
-                    Request payload: {payload}
-                """
-                cls.logger.error(error_message)
-                raise requests.exceptions.HTTPError from exc
+                if response.status_code == 429:
+                    cls.rate_limiter.throttled(url)
+                if policy.should_retry(response.status_code, idempotent) and (
+                    (delay := policy.delay(attempt, started, response)) is not None
+                ):
+                    cls.logger.info(
+                        "Server busy (%d). Retrying in %.1fs...",
+                        response.status_code,
+                        delay,
+                    )
+                else:
+                    if response.status_code in policy.statuses:
+                        policy.record_failure()
+                    log_http_error(cls, response, kwargs.get("data", "none"))
+                    raise requests.exceptions.HTTPError(response=response) from exc
             else:
-                request_success = True
-            # time.sleep(3)
-        return response
+                cls.rate_limiter.succeeded(url)
+                return response
+            policy.record_retry()
+            time.sleep(delay)
 
     return inner_func
 
 
+class BatchNotSupported(ValueError):
+    """The server did not answer a batch of queries with a list of results."""
+
+
+def batch_rejected(exc: Exception) -> bool:
+    """Whether the error means that the server does not take batched queries
+    at all -- rather than a failure of that one request."""
+    if isinstance(exc, BatchNotSupported):
+        return True
+    response = getattr(exc, "response", None)
+    return (
+        isinstance(exc, requests.exceptions.HTTPError)
+        and getattr(response, "status_code", None) == 400
+    )
+
+
 @logged
 class Session(requests.Session):
     """
@@ -78,8 +207,62 @@ class Session(requests.Session):
     after completing the request.
     """
 
+    def __init__(
+        self,
+        retry_policy: RetryPolicy = None,
+        limiter: RateLimiter = None,
+        transport: Transport = None,
+        cache: ResponseCache = None,
+    ):
+        super().__init__()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # the limits, connection pools and cache are shared with the other
+        # sessions unless told otherwise
+        self.rate_limiter = limiter or rate_limiter
+        self.transport = transport or default_transport
+        if cache is None and settings.CACHE_ENABLED:
+            cache = default_cache()
+        self.cache = cache
+        self.timeout = settings.REQUEST_TIMEOUT
+
+    def get_adapter(self, url):
+        if url.lower().startswith(("http://", "https://")):
+            return self.transport.adapter(url)
+        return super().get_adapter(url)
+
+    def request(
+        self,
+        method,
+        url,
+        cache=False,
+        updated_at=None,
+        expires=False,
+        idempotent=True,
+        **kwargs,
+    ):
+        """
+        Send the request. With cache=True the response to the same query and
+        variables is reused: while it is younger than the cache ttl or, if
+        updated_at is given, while the object has not been updated since (and,
+        with expires, is younger than the ttl too). Requests that are not
+        idempotent are not retried when they may have reached the server.
+        """
+        if not (cache and self.cache):
+            return self._request(method, url, idempotent=idempotent, **kwargs)
+
+        key = self.cache.key(url, kwargs.get("json"))
+        content = self.cache.get(key, updated_at, expires)
+        if content is not None:
+            return cached_response(url, content)
+        response = self._request(method, url, idempotent=idempotent, **kwargs)
+        if cacheable(response):
+            self.cache.set(key, response.content, updated_at)
+        return response
+
     @check_errors
-    def request(self, method, url, **kwargs):
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        self.rate_limiter.wait(url)
         return super().request(method, url, **kwargs)
 
 
@@ -100,6 +283,15 @@ class BaseClient:
     def __del__(self):
         self.session.close()
 
+    @property
+    def retry_policy(self) -> RetryPolicy:
+        """How failed requests are retried. Replace it to change it for this client."""
+        return self.session.retry_policy
+
+    @retry_policy.setter
+    def retry_policy(self, policy: RetryPolicy):
+        self.session.retry_policy = policy
+
     def quit(self):
         """
         Kill the client.
@@ -162,9 +354,42 @@ class AIDScrapper(BaseClient):
         self.wi_query = schemes.wi_query
         self.aid_loginpayload = schemes.aid_loginpayload
 
-        self.offset = 0
+        self.workers = settings.DEFAULT_WORKERS
+        # where unfinished scenario crawls are saved. None to disable it.
+        self.crawl_dir = settings.CRAWL_DIR
+        # send related queries in one request. Disabled when the server rejects it.
+        self.batch_queries = settings.BATCH_QUERIES
+        # publicId -> updatedAt as seen in the search results. Used to
+        # revalidate the cached objects.
+        self.updated_at: Dict[str, str] = {}
+        # publicId -> (key, updatedAt) of the objects already archived. Only
+        # used by incremental syncs, see load_archive.
+        self.archived: Dict[str, Tuple[Any, str]] = {}
+
+    @property
+    def workers(self) -> int:
+        """How many objects are downloaded at the same time."""
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers: int):
+        self._workers = workers
+        # one connection per thread or they will wait for each other
+        self.session.transport.reserve(self.url, workers)
 
     def login(self, credentials=None):
+        credentials = self._credentials(credentials)
+
+        key = self.get_login_token(credentials)
+
+        self.session.headers.update({"x-access-token": key})
+        self.logger.info(
+            'User "%s" sucessfully logged into AID', credentials["username"]
+        )
+
+    def _credentials(self, credentials=None) -> Dict[str, str]:
+        """Get the credentials from the secrets file or the console if they
+        were not passed directly."""
         if not credentials:
             try:
                 self.logger.info("Trying to log-in via file...")
@@ -180,35 +405,105 @@ class AIDScrapper(BaseClient):
             credentials = {"username": username, "password": password}
         else:
             self.logger.info("Credentials were passed to the function directly...")
-
-        key = self.get_login_token(credentials)
-
-        self.session.headers.update({"x-access-token": key})
-        self.logger.info(
-            'User "%s" sucessfully logged into AID', credentials["username"]
-        )
+        return credentials
 
     def _get_story_content(self, story_id: str) -> Dict[str, Any]:
-        self.story_query.update({"variables": {"publicId": story_id}})
-        adventure = self.session.post(self.url, json=self.story_query).json()["data"][
-            "adventure"
-        ]
+        # a new payload for each call since this runs in the worker threads
+        query = {**self.story_query, "variables": {"publicId": story_id}}
+        adventure = self.session.post(
+            self.url, json=query, cache=True, updated_at=self.updated_at.get(story_id)
+        ).json()["data"]["adventure"]
         return adventure
 
-    def _get_scenario_content(self, scenario_id: str) -> Dict[str, Any]:
-        self.scenario_query.update({"variables": {"publicId": scenario_id}})
-        wi = self._get_wi(scenario_id)
-        scenario = self.session.post(self.url, json=self.scenario_query).json()["data"][
-            "scenario"
-        ]
+    def _get_scenario_content(
+        self, scenario_id: str, parent_updated_at: str = None
+    ) -> Dict[str, Any]:
+        """The scenario with its world info. The cached answers are revalidated
+        by its updatedAt in the search results. An option has none: it is
+        revalidated by the one of the scenario that listed it -- refetched when
+        that one changed -- and expires after the cache ttl like the rest."""
+        updated_at, expires = self._revalidation(scenario_id, parent_updated_at)
+        scenario_query = {**self.scenario_query, "variables": {"publicId": scenario_id}}
+        if self.batch_queries:
+            try:
+                scenario_res, wi_res = self._post_batch(
+                    [scenario_query, self._wi_payload(scenario_id)],
+                    updated_at,
+                    expires,
+                )
+                scenario = scenario_res["data"]["scenario"]
+                scenario.update({"worldInfo": wi_res["data"]["worldInfoType"]})
+                return scenario
+            except (
+                requests.exceptions.HTTPError,
+                ValueError,
+                KeyError,
+                TypeError,
+            ) as exc:
+                self._batch_failed(scenario_id, exc)
+
+        wi = self._get_wi(scenario_id, updated_at, expires)
+        scenario = self.session.post(
+            self.url,
+            json=scenario_query,
+            cache=True,
+            updated_at=updated_at,
+            expires=expires,
+        ).json()["data"]["scenario"]
         scenario.update({"worldInfo": wi})
         return scenario
 
-    def _get_wi(self, scenario_id: str) -> Dict[str, Any]:
-        self.wi_query["variables"].update({"contentPublicId": scenario_id})
-        return self.session.post(self.url, json=self.wi_query).json()["data"][
-            "worldInfoType"
-        ]
+    def _batch_failed(self, scenario_id: str, exc: Exception):
+        if batch_rejected(exc):
+            self.logger.info(
+                "The server does not accept batched queries. "
+                "Sending them one by one from now on."
+            )
+            self.batch_queries = False
+        else:
+            self.logger.info(
+                "The batched queries of %s failed (%r). Sending them one by one.",
+                scenario_id,
+                exc,
+            )
+
+    def _post_batch(
+        self,
+        queries: List[Dict[str, Any]],
+        updated_at: str = None,
+        expires: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """Send several GraphQL operations in one request. The results are
+        returned in the same order as the queries."""
+        results = self.session.post(
+            self.url,
+            json=queries,
+            cache=True,
+            updated_at=updated_at,
+            expires=expires,
+        ).json()
+        if not isinstance(results, list) or len(results) != len(queries):
+            raise BatchNotSupported(
+                "The server did not answer with one result per query"
+            )
+        return results
+
+    def _wi_payload(self, scenario_id: str) -> Dict[str, Any]:
+        return {
+            **self.wi_query,
+            "variables": {**self.wi_query["variables"], "contentPublicId": scenario_id},
+        }
+
+    def _get_wi(
+        self, scenario_id: str, updated_at: str = None, expires: bool = False
+    ) -> Dict[str, Any]:
+        return self.session.post(
+            self.url,
+            json=self._wi_payload(scenario_id),
+            cache=True,
+            updated_at=updated_at,
+            expires=expires,
+        ).json()["data"]["worldInfoType"]
 
     def _query_objects(self, query: dict, term: str = "") -> Dict[str, Any]:
         query["variables"]["input"]["searchTerm"] = (
@@ -219,67 +514,257 @@ class AIDScrapper(BaseClient):
             "user"
         ]["search"]
 
+    def _pages(self, query: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
+        """Yield the search results page by page. The next page is requested in
+        the background while the caller is busy with the current one."""
+        query = copy.deepcopy(query)
+        query["variables"]["input"]["offset"] = offset = 0
+
+        prefetcher = ThreadPoolExecutor(max_workers=1)
+        next_page = prefetcher.submit(self._query_objects, query)
+        try:
+            while True:
+                result = list(next_page.result())
+                if not result:
+                    return
+                self._remember_updates(result)
+                # the query is only touched once the previous request is done
+                offset += len(result)
+                query["variables"]["input"]["offset"] = offset
+                next_page = prefetcher.submit(self._query_objects, query)
+
+                yield result
+        finally:
+            # the caller stopped early (or we are done) -- drop the prefetched page
+            next_page.cancel()
+            prefetcher.shutdown(wait=False)
+
+    def _remember_updates(self, result: List[Dict[str, Any]]):
+        self.updated_at.update(
+            (obj["publicId"], obj["updatedAt"])
+            for obj in result
+            if isinstance(obj, dict) and obj.get("updatedAt")
+        )
+
+    def load_archive(self, container):
+        """
+        Load the objects already downloaded to the container and remember their
+        updatedAt. From then on, get_stories/get_scenarios only download the
+        objects that are new or were updated and replace the old versions.
+        Options of scenarios are only downloaded again when the scenario itself
+        was updated.
+        """
+        try:
+            container.load()
+        except FileNotFoundError:
+            self.logger.info("Nothing to sync with, downloading everything.")
+        self.archived.update(container.index())
+
+    def _in_sync(self, obj: Dict[str, Any]) -> bool:
+        """The archived version of the object is the current one."""
+        if not self.archived:
+            return False
+        archived = self.archived.get(obj["publicId"])
+        return archived is not None and archived[1] == obj["updatedAt"]
+
+    def _forget(self, container, pubid: str):
+        """Drop the archived version of an object that is about to be replaced."""
+        if pubid not in self.archived:
+            return None
+        key, _ = self.archived.pop(pubid)
+        if key not in container:
+            return None
+        return key, container.pop(key)
+
+    @staticmethod
+    def _restore(container, stale):
+        if stale:
+            key, value = stale
+            container[key] = value
+
     def get_stories(self):
-        while True:
-            result: List[Dict[str, Any]] = self._query_objects(self.stories_query)
-
-            if any(result):
-                assert result, "No result?"
-
-                for story in result:
-                    s = self._get_story_content(story["publicId"])
-                    self.offset += 1
-                    if not self.adventures.title:
-                        # To optimize queries -- stop when we are under self.adventures.min_act actions
-                        try:
-                            self.adventures._add(s)
-                        except ValidationError as exc:
-                            self.logger.debug(exc)
-                            # actions are under the limit. Abort.
-                            return
-                    else:
-                        self.adventures.add(s)
-                    self.logger.info('Loaded story: "%s"', story["title"])
+        pages = self._pages(self.stories_query)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, closing(pages):
+            for result in pages:
+                # the bodies are downloaded concurrently but added in the
+                # same order the search returned them
+                result = [story for story in result if not self._in_sync(story)]
+                futures = [
+                    executor.submit(self._get_story_content, story["publicId"])
+                    for story in result
+                ]
+                for story, future in zip(result, futures):
+                    if not self._add_story(story, future.result()):
+                        for pending in futures:
+                            pending.cancel()
+                        return
                 self.logger.debug("Got %d stories so far", len(self.adventures))
-                self.stories_query["variables"]["input"]["offset"] = self.offset
-            else:
-                self.logger.info("All stories downloaded")
-                return
+            self.logger.info("All stories downloaded")
+
+    def _add_story(self, story: Dict[str, Any], content: Dict[str, Any]) -> bool:
+        """Add the downloaded story. False means that there is no point in
+        downloading more of them."""
+        stale = self._forget(self.adventures, story["publicId"])
+        if not self.adventures.title:
+            # To optimize queries -- stop when we are under self.adventures.min_act actions
+            try:
+                self.adventures._add(content)
+            except ValidationError as exc:
+                self.logger.debug(exc)
+                self._restore(self.adventures, stale)
+                # actions are under the limit. Abort.
+                return False
+        else:
+            self.adventures.add(content)
+        self.adventures.checkpoint()
+        self.logger.info('Loaded story: "%s"', story["title"])
+        return True
 
     def get_scenarios(self):
-        while True:
-            result: List[Dict[str, Any]] = self._query_objects(self.scenarios_query)
-
-            if any(result):
-                assert result, "No result?"
+        with closing(self._pages(self.scenarios_query)) as pages:
+            for result in pages:
                 for scenario in result:
+                    if self._in_sync(scenario):
+                        continue
+                    self._forget(self.prompts, scenario["publicId"])
                     self.add_all_scenarios(scenario["publicId"])
                 self.logger.debug("Got %d scenarios so far", len(self.prompts))
-                self.scenarios_query["variables"]["input"]["offset"] = self.offset
-            else:
-                self.logger.info("All scenarios downloaded")
-                self.offset = 0
-                break
+        self.logger.info("All scenarios downloaded")
 
     def add_all_scenarios(self, pubid, isOption=False) -> List[Dict[str, Any]]:
-        """Adds all scenarios and their children to memory"""
+        """Adds all scenarios and their children to memory.
+
+        The scenario tree is crawled breadth-first, fetching up to self.workers
+        options at the same time. Every option is fetched once even if several
+        scenarios point to it. The crawl is saved after each batch so an
+        interrupted crawl continues where it stopped the next time it is called
+        with the same pubid.
+        """
+        crawl = self._new_crawl(pubid, isOption)
+        frontier = deque(crawl["frontier"])
+        visited = set(crawl["visited"])
+        scenarios = crawl["scenarios"]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while frontier:
+                batch = [
+                    frontier.popleft() for _ in range(min(self.workers, len(frontier)))
+                ]
+                fetched = executor.map(
+                    lambda node: self._get_scenario_content(
+                        node[0], self._parent_updated_at(node)
+                    ),
+                    batch,
+                )
+                for node, scenario in zip(batch, fetched):
+                    self._expand(node, scenario, frontier, visited)
+                    scenarios.append(scenario)
+                self._save_crawl(pubid, frontier, visited, scenarios[-len(batch) :])
+
+        self._add_crawled(pubid, scenarios)
+
+    def _revalidation(
+        self, scenario_id: str, parent_updated_at: str = None
+    ) -> Tuple[Optional[str], bool]:
+        """updated_at and expires of the cached answers about a scenario, see
+        _get_scenario_content."""
+        updated_at = self.updated_at.get(scenario_id)
+        if updated_at is None and parent_updated_at is not None:
+            return parent_updated_at, True
+        return updated_at, False
 
-        scenario: Dict[str, Any] = self._get_scenario_content(pubid)
-        scenario["isOption"] = isOption
+    @staticmethod
+    def _parent_updated_at(node) -> Optional[str]:
+        # the nodes of crawls saved before it was recorded have no third item
+        return node[2] if len(node) > 2 else None
+
+    @staticmethod
+    def _expand(node, scenario: Dict[str, Any], frontier: deque, visited: set):
+        """Queue the options of a crawled scenario that were not seen yet."""
+        scenario["isOption"] = node[1]
 
         if "options" in scenario and isinstance(scenario["options"], Sequence):
+            updated_at = scenario["updatedAt"] if "updatedAt" in scenario else None
             for option in scenario["options"]:
-                self.add_all_scenarios(option["publicId"], True)
-        self.prompts.add(scenario)
-        self.offset += 1 if not isOption else 0
-        self.logger.info("Added %s to memory", scenario["title"])
+                if option["publicId"] not in visited:
+                    visited.add(option["publicId"])
+                    frontier.append([option["publicId"], True, updated_at])
+
+    def _add_crawled(self, pubid, scenarios: List[Dict[str, Any]]):
+        # children go first -- like the old depth-first walk did -- so the
+        # parents are read before their options when the archive is reversed
+        for scenario in reversed(scenarios):
+            self.prompts.add(scenario)
+            self.logger.info("Added %s to memory", scenario["title"])
+        self.prompts.checkpoint()
+        self._clear_crawl(pubid)
+
+    def _crawl_files(self, pubid: str):
+        return (
+            self.crawl_dir / f"{pubid}.json",
+            self.crawl_dir / f"{pubid}.scenarios.json",
+        )
+
+    def _new_crawl(self, pubid: str, isOption: bool) -> Dict[str, Any]:
+        return self._load_crawl(pubid) or {
+            "frontier": [[pubid, isOption]],
+            "visited": [pubid],
+            "scenarios": [],
+        }
+
+    def _load_crawl(self, pubid: str) -> Dict[str, Any]:
+        """Get the saved state of an unfinished crawl, if any."""
+        if not self.crawl_dir:
+            return {}
+        state_file, scenarios_file = self._crawl_files(pubid)
+        try:
+            with open(state_file) as file:
+                crawl = json.load(file)
+            with open(scenarios_file) as file:
+                # one scenario per line, appended as they are fetched
+                crawl["scenarios"] = [json.loads(line) for line in file if line.strip()]
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+        self.logger.info(
+            "Resuming crawl of %s. %d scenarios already fetched.",
+            pubid,
+            len(crawl["scenarios"]),
+        )
+        return crawl
+
+    def _save_crawl(self, pubid: str, frontier, visited, new_scenarios):
+        if not self.crawl_dir:
+            return
+        state_file, scenarios_file = self._crawl_files(pubid)
+        with open(scenarios_file, "a") as file:
+            for scenario in new_scenarios:
+                file.write(json.dumps(scenario) + "\n")
+        with open(state_file, "w") as file:
+            json.dump({"frontier": list(frontier), "visited": list(visited)}, file)
+
+    def _clear_crawl(self, pubid: str):
+        if not self.crawl_dir:
+            return
+        for crawl_file in self._crawl_files(pubid):
+            try:
+                os.remove(crawl_file)
+            except FileNotFoundError:
+                pass
 
     def get_login_token(self, credentials: Dict[str, Any]):
+        res = self.session.post(
+            self.url, data=json.dumps(self._login_payload(credentials))
+        ).json()
+        return self._login_token(res)
+
+    def _login_payload(self, credentials: Dict[str, Any]) -> Dict[str, Any]:
         self.aid_loginpayload["variables"]["identifier"] = self.aid_loginpayload[
             "variables"
         ]["email"] = credentials["username"]
         self.aid_loginpayload["variables"]["password"] = credentials["password"]
-        res = self.session.post(self.url, data=json.dumps(self.aid_loginpayload)).json()
+        return self.aid_loginpayload
+
+    def _login_token(self, res: Dict[str, Any]):
         if "data" in res:
             try:
                 token = res["data"]["login"]["accessToken"]
@@ -295,28 +780,33 @@ class AIDScrapper(BaseClient):
     def upload_in_bulk(self, scenarios: Dict[str, Any]):
         for key in scenarios:
             scenario = scenarios[key]
+            if isinstance(scenario, Record):
+                scenario = scenario.to_dict()
 
             assert isinstance(scenario, dict)
 
+            # sent twice, it would create two scenarios
             res = self.session.post(
-                self.url, data=json.dumps(self.create_scen_payload)
+                self.url, data=json.dumps(self.create_scen_payload), idempotent=False
             ).json()["data"]["createScenario"]
-            scenario.update({"publicId": res["publicId"]})
-            new_scenario = self.update_scen_payload.copy()
-
-            # (XXX) This process have been delegated to the
-            # data models. Maybe wait for me to make a proper "Scenario" object
-            # to refactor it?
-            clean_scenario = {
-                k: v
-                for k, v in scenario.items()
-                if k in new_scenario["variables"]["input"]
-            }
-
-            new_scenario.update({"variables": {"input": clean_scenario}})
+            new_scenario = self._update_payload(scenario, res["publicId"])
             self.session.post(self.url, data=json.dumps(new_scenario))
             self.logger.info("%s successfully uploaded...", scenario["title"])
 
+    def _update_payload(self, scenario: Dict[str, Any], pubid: str) -> Dict[str, Any]:
+        scenario.update({"publicId": pubid})
+        new_scenario = self.update_scen_payload.copy()
+
+        # (XXX) This process have been delegated to the
+        # data models. Maybe wait for me to make a proper "Scenario" object
+        # to refactor it?
+        clean_scenario = {
+            k: v for k, v in scenario.items() if k in new_scenario["variables"]["input"]
+        }
+
+        new_scenario.update({"variables": {"input": clean_scenario}})
+        return new_scenario
+
 
 class ClubClient(BaseClient):
     def __init__(self):
@@ -441,11 +931,11 @@ class ClubClient(BaseClient):
                 except KeyError:
                     pass
 
-                res = self.session.post(variables[1], params)
+                # an absolute url, for the rate limiter of the club's host to
+                # take care of not overloading his servers
+                res = self.session.post(self.url + variables[1], params)
 
                 print(f'Your prompts number is {res.url.split("/")[-1]}')
-                # I don't want to overload his servers...
-                time.sleep(1)
 
 
 class HoloClient(BaseClient):
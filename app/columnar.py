@@ -0,0 +1,391 @@
+"""
+Columnar store for the actions of a story archive. Instead of a dict per
+action, all the actions of all the stories sit in a few flat arrays:
+
+    texts          every text, UTF-8 encoded, one after the other
+    offsets        where the text of each action starts in `texts`, plus
+                   the end of the last one
+    types          code of the type of each action, see `type_names`
+    story_numbers  number of the story each action belongs to
+    timestamps     createdAt, in milliseconds since the epoch
+    ids            the action ids, as numbers
+    starts         where the actions of each story start, plus the end
+
+The rest of each story is kept as it is. A saved store is memory-mapped when
+loaded, so its size does not matter: the actions are only decoded when they
+are read, and the arrays can be scanned without building Python objects.
+"""
+
+import collections.abc
+import json
+import mmap
+import os
+import struct
+import sys
+import uuid
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+from aids.app.records import ACTION_TYPES, DIGITS, TIMESTAMP, encode
+from aids.app.writelogs import logged
+
+MAGIC = b"AIDSCOL1"
+# the layout of the actions that fit in the columns
+ACTION_KEYS = ("id", "text", "type", "createdAt")
+# placeholder of the values that are in `extras` instead
+MISSING = -(2**63)
+IRREGULAR = 255
+
+# name -> array typecode
+ARRAYS = {
+    "offsets": "Q",
+    "types": "B",
+    "story_numbers": "I",
+    "timestamps": "q",
+    "ids": "q",
+    "starts": "Q",
+}
+
+
+def _aligned(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+class StoryActions(collections.abc.Sequence):
+    """The actions of one story: a view over the columns, nothing is copied.
+    The actions are decoded to dicts as they are read."""
+
+    def __init__(self, columns: "ActionColumns", start: int, stop: int):
+        self.columns = columns
+        self.start = start
+        self.stop = stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[position] for position in range(start, stop, step)]
+            return StoryActions(self.columns, self.start + start, self.start + stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("action index out of range")
+        return self.columns.action(self.start + index)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        action = self.columns.action
+        return (action(number) for number in range(self.start, self.stop))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, collections.abc.Sequence) and not isinstance(other, str):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"<{len(self)} actions>"
+
+    def __reduce__(self):
+        # a view can not leave the process, its actions can
+        return (list, (list(self),))
+
+    @property
+    def texts(self) -> memoryview:
+        """UTF-8 texts of all the actions of the view, back to back."""
+        offsets = self.columns.offsets
+        return self.columns.texts[offsets[self.start] : offsets[self.stop]]
+
+    @property
+    def types(self) -> memoryview:
+        return self.columns.types[self.start : self.stop]
+
+    @property
+    def timestamps(self) -> memoryview:
+        return self.columns.timestamps[self.start : self.stop]
+
+
+@logged
+class ActionColumns:
+    """
+    The actions of many stories, see the module documentation. Build it with
+    from_stories, or load a saved one:
+
+        columns = ActionColumns.from_stories(stories.values())
+        columns.save("story.columns")
+
+        columns = ActionColumns.load("story.columns")
+        for story in columns.stories():
+            ...
+
+    Actions that do not fit the columns -- other fields, an id that is not
+    a number, a date in another format -- are kept whole in `extras`, so
+    converting back gives exactly the same dicts.
+    """
+
+    def __init__(
+        self,
+        texts,
+        offsets,
+        types,
+        story_numbers,
+        timestamps,
+        ids,
+        starts,
+        type_names: List[str],
+        extras: Dict[int, Dict[str, Any]],
+        metadata: List[Dict[str, Any]],
+        inline: Iterable[int] = (),
+        buffer: Optional[mmap.mmap] = None,
+    ):
+        # memoryviews: slicing them does not copy
+        self.texts = memoryview(texts)
+        self.offsets = memoryview(offsets)
+        self.types = memoryview(types)
+        self.story_numbers = memoryview(story_numbers)
+        self.timestamps = memoryview(timestamps)
+        self.ids = memoryview(ids)
+        self.starts = memoryview(starts)
+        self.type_names = type_names
+        self.extras = extras
+        # the stories without their actions. None marks where they go, except
+        # in the `inline` stories, whose actions are not a list and stay there.
+        self.metadata = metadata
+        self.inline = set(inline)
+        self._buffer = buffer
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    @property
+    def story_count(self) -> int:
+        return len(self.metadata)
+
+    @classmethod
+    def from_stories(cls, stories: Iterable[Dict[str, Any]]) -> "ActionColumns":
+        texts = bytearray()
+        columns = {name: array(code) for name, code in ARRAYS.items()}
+        offsets, types, story_numbers, timestamps, ids, starts = (
+            columns[name] for name in ARRAYS
+        )
+        offsets.append(0)
+        starts.append(0)
+        type_codes = {name: code for code, name in enumerate(ACTION_TYPES)}
+        extras: Dict[int, Dict[str, Any]] = {}
+        metadata: List[Dict[str, Any]] = []
+        inline: List[int] = []
+
+        for story_number, story in enumerate(stories):
+            actions = story.get("actions")
+            if not isinstance(actions, collections.abc.Sequence) or isinstance(
+                actions, str
+            ):
+                # no actions to store, the story stays as it is
+                metadata.append(dict(story))
+                inline.append(story_number)
+                starts.append(len(types))
+                continue
+            metadata.append(
+                {key: None if key == "actions" else story[key] for key in story}
+            )
+
+            for action in actions:
+                number = len(types)
+                if isinstance(action, collections.abc.Mapping):
+                    action_id = DIGITS[0](action.get("id"))
+                    timestamp = TIMESTAMP[0](action.get("createdAt"))
+                    text = action.get("text")
+                    type_name = action.get("type")
+                    type_code = None
+                    if isinstance(type_name, str):
+                        type_code = type_codes.get(type_name)
+                        if type_code is None and len(type_codes) < IRREGULAR:
+                            type_code = type_codes[type_name] = len(type_codes)
+                    regular = (
+                        tuple(action.keys()) == ACTION_KEYS
+                        and action_id is not None
+                        and timestamp is not None
+                        and isinstance(text, str)
+                        and type_code is not None
+                    )
+                else:
+                    regular, text = False, None
+
+                if not regular:
+                    extras[number] = (
+                        dict(action)
+                        if isinstance(action, collections.abc.Mapping)
+                        else action
+                    )
+                    action_id, timestamp, type_code = MISSING, MISSING, IRREGULAR
+                # the text is in the columns even then, to be scanned
+                texts += text.encode("utf-8") if isinstance(text, str) else b""
+                offsets.append(len(texts))
+                types.append(type_code)
+                story_numbers.append(story_number)
+                timestamps.append(timestamp)
+                ids.append(action_id)
+            starts.append(len(types))
+
+        type_names = sorted(type_codes, key=type_codes.get)
+        return cls(
+            texts,
+            offsets,
+            types,
+            story_numbers,
+            timestamps,
+            ids,
+            starts,
+            type_names,
+            extras,
+            metadata,
+            inline,
+        )
+
+    # --- reading ---
+    def text(self, number: int) -> str:
+        return str(self.text_bytes(number), "utf-8")
+
+    def text_bytes(self, number: int) -> memoryview:
+        return self.texts[self.offsets[number] : self.offsets[number + 1]]
+
+    def action(self, number: int) -> Dict[str, Any]:
+        if number in self.extras:
+            extra = self.extras[number]
+            return dict(extra) if isinstance(extra, dict) else extra
+        return {
+            "id": DIGITS[1](self.ids[number]),
+            "text": self.text(number),
+            "type": self.type_names[self.types[number]],
+            "createdAt": TIMESTAMP[1](self.timestamps[number]),
+        }
+
+    def story_actions(self, story_number: int) -> StoryActions:
+        return StoryActions(
+            self, self.starts[story_number], self.starts[story_number + 1]
+        )
+
+    def story(self, story_number: int) -> Dict[str, Any]:
+        """The story with its actions as a view over the columns."""
+        story = dict(self.metadata[story_number])
+        if story_number not in self.inline and "actions" in story:
+            story["actions"] = self.story_actions(story_number)
+        return story
+
+    def stories(self) -> Iterator[Dict[str, Any]]:
+        return (self.story(number) for number in range(self.story_count))
+
+    def type_code(self, name: str) -> int:
+        return self.type_names.index(name)
+
+    # --- files ---
+    def save(self, path: Union[str, Path]):
+        """Write the columns to a file that load can map into memory. The file
+        is replaced once complete."""
+        path = Path(path)
+        layout = {}
+        position = 0
+        sections = [("texts", "B", self.texts)] + [
+            (name, code, getattr(self, name)) for name, code in ARRAYS.items()
+        ]
+        for name, code, view in sections:
+            position = _aligned(position)
+            layout[name] = [position, view.nbytes, code]
+            position += view.nbytes
+        header = json.dumps(
+            {
+                "byteorder": sys.byteorder,
+                "type_names": self.type_names,
+                "extras": {str(number): extra for number, extra in self.extras.items()},
+                "metadata": self.metadata,
+                "inline": sorted(self.inline),
+                "layout": layout,
+            },
+            # the metadata of compact stories holds records
+            default=encode,
+        ).encode("utf-8")
+        data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, "wb") as file:
+                file.write(MAGIC + struct.pack("<Q", len(header)) + header)
+                for name, code, view in sections:
+                    file.seek(data_start + layout[name][0])
+                    file.write(view)
+                # the last sections can be empty
+                file.truncate(data_start + position)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "ActionColumns":
+        """Map a saved store into memory. Nothing is read until it is used."""
+        with open(path, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[: len(MAGIC)] != MAGIC:
+            buffer.close()
+            raise ValueError(f"{path} is not a columnar store")
+        (header_size,) = struct.unpack_from("<Q", buffer, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(buffer[start : start + header_size])
+        if header["byteorder"] != sys.byteorder:
+            buffer.close()
+            raise ValueError(f"{path} was saved on a machine of other byte order")
+
+        data_start = _aligned(start + header_size)
+        view = memoryview(buffer)
+        sections = {}
+        for name, (offset, size, code) in header["layout"].items():
+            section = view[data_start + offset : data_start + offset + size]
+            sections[name] = section if code == "B" else section.cast(code)
+        return cls(
+            sections["texts"],
+            *(sections[name] for name in ARRAYS),
+            type_names=header["type_names"],
+            extras={int(number): extra for number, extra in header["extras"].items()},
+            metadata=header["metadata"],
+            inline=header["inline"],
+            buffer=buffer,
+        )
+
+
+class ColumnarStorage:
+    """Storage backend (see aids.app.storage) that saves a Story container as
+    a columnar store. Loading it maps the file, the actions of the stories
+    are views over it. Every save rewrites the file, checkpoint does nothing."""
+
+    suffix = ".columns"
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._read = 0
+        self._total = 0
+
+    def load(self) -> Iterator[Dict[str, Any]]:
+        columns = ActionColumns.load(self.path)
+        self._total = columns.story_count
+        for self._read, story in enumerate(columns.stories(), 1):
+            yield story
+
+    def progress(self) -> int:
+        """Percentage of the stories read by load so far."""
+        return 100 * self._read // max(self._total, 1)
+
+    def save(self, container):
+        ActionColumns.from_stories(container.values()).save(self.path)
+        container.dirty.clear()
+
+    def checkpoint(self, container):
+        pass
+
+    def backup(self, target: Union[str, Path]):
+        # aids.app.storage imports this module
+        from aids.app.storage import copy_file
+
+        # the file is replaced on save, never modified, so a link is enough
+        copy_file(self.path, target)
@@ -0,0 +1,281 @@
+import json
+import threading
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from aids.app.records import encode
+from aids.app.writelogs import logged
+from aids.app import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    publicId TEXT,
+    title TEXT,
+    createdAt TEXT,
+    updatedAt TEXT,
+    actions INTEGER,
+    isOption INTEGER NOT NULL DEFAULT 0,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_publicId ON objects (publicId);
+CREATE INDEX IF NOT EXISTS objects_title ON objects (title);
+CREATE INDEX IF NOT EXISTS objects_createdAt ON objects (createdAt);
+CREATE INDEX IF NOT EXISTS objects_updatedAt ON objects (updatedAt);
+CREATE INDEX IF NOT EXISTS objects_actions ON objects (actions);
+CREATE INDEX IF NOT EXISTS objects_isOption ON objects (isOption);
+"""
+
+
+def _encode_key(key) -> str:
+    # story keys are (title, actions) tuples
+    return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+
+def _decode_key(raw: str):
+    key = json.loads(raw)
+    return tuple(key) if isinstance(key, list) else key
+
+
+@logged
+class ArchiveDatabase(MutableMapping):
+    """
+    Stories or scenarios in a SQLite database. It is keyed like the containers
+    but only the objects being read are in memory, and the archive can be
+    searched by the indexed fields with find:
+
+        stories = ArchiveDatabase("story.sqlite3")
+        long_ones = stories.find(title="Duty Calls", min_actions=100)
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        batch_size: int = settings.DATABASE_BATCH_SIZE,
+    ):
+        if not sqlite3:
+            raise ImportError(
+                "Your Python was built without sqlite3, the database can not be used."
+            )
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    @staticmethod
+    def _row(key, value: Dict[str, Any]) -> Tuple:
+        actions = value.get("actions")
+        return (
+            _encode_key(key),
+            value.get("publicId"),
+            value.get("title"),
+            value.get("createdAt"),
+            value.get("updatedAt"),
+            len(actions) if isinstance(actions, list) else None,
+            int(bool(value.get("isOption"))),
+            json.dumps(value, default=encode),
+        )
+
+    def __getitem__(self, key) -> Dict[str, Any]:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT body FROM objects WHERE key = ?", (_encode_key(key),)
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value: Dict[str, Any]):
+        self.add_many([(key, value)])
+
+    def __delitem__(self, key):
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM objects WHERE key = ?", (_encode_key(key),)
+            )
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator:
+        with self._lock:
+            keys = self.connection.execute(
+                "SELECT key FROM objects ORDER BY rowid"
+            ).fetchall()
+        return (_decode_key(key) for key, in keys)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM objects WHERE key = ?", (_encode_key(key),)
+                ).fetchone()
+                is not None
+            )
+
+    def values(self) -> Iterator[Dict[str, Any]]:
+        """Every object in the order they were last written, read lazily."""
+        return self._select("", ())
+
+    def _select(self, where: str, params: Tuple) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            cursor = self.connection.execute(
+                f"SELECT body FROM objects {where} ORDER BY rowid", params
+            )
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                return
+            for (body,) in rows:
+                yield json.loads(body)
+
+    def add_many(self, items: Iterable[Tuple[Any, Dict[str, Any]]]):
+        """Insert or replace the objects, batch_size of them per transaction."""
+        rows: List[Tuple] = []
+        for key, value in items:
+            rows.append(self._row(key, value))
+            if len(rows) >= self.batch_size:
+                self._insert(rows)
+                rows = []
+        if rows:
+            self._insert(rows)
+
+    def _insert(self, rows: List[Tuple]):
+        with self._lock, self.connection:
+            # a replaced row gets a new rowid -- it goes to the end, like the
+            # objects updated in a JSON Lines archive
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO objects "
+                "(key, publicId, title, createdAt, updatedAt, actions, isOption, body) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def delete_many(self, keys: Iterable):
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM objects WHERE key = ?",
+                ((_encode_key(key),) for key in keys),
+            )
+
+    def find(
+        self,
+        title: str = None,
+        publicId: str = None,
+        min_actions: int = None,
+        max_actions: int = None,
+        isOption: bool = None,
+        created_since: str = None,
+        updated_since: str = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """The objects that match all the given fields. Dates are compared as
+        the ISO strings AID uses."""
+        conditions = []
+        params = []
+        for condition, param in (
+            ("title = ?", title),
+            ("publicId = ?", publicId),
+            ("actions >= ?", min_actions),
+            ("actions <= ?", max_actions),
+            ("isOption = ?", None if isOption is None else int(isOption)),
+            ("createdAt >= ?", created_since),
+            ("updatedAt >= ?", updated_since),
+        ):
+            if param is not None:
+                conditions.append(condition)
+                params.append(param)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._select(where, tuple(params))
+
+    def import_objects(self, container, objects: Iterable[Dict[str, Any]]) -> int:
+        """
+        Validate the objects with the container and save them, batch_size at a
+        time, so an archive of any size can be migrated. The container is used
+        as a buffer and left empty. Returns how many objects were read.
+        """
+        number = 0
+        for number, value in enumerate(objects, 1):
+            try:
+                container.add(value)
+            except (KeyError, TypeError, AttributeError) as exc:
+                self.logger_err.error(
+                    "Object number %d is malformed, skipping it: %r", number, exc
+                )
+            if len(container) >= self.batch_size:
+                self.add_many(container.items())
+                container.clear()
+        self.add_many(container.items())
+        container.clear()
+        self.logger.info("%d objects imported into %s", number, self.path)
+        return number
+
+    def backup(self, target: Union[str, Path]):
+        """Consistent copy of the database, even while it is being written."""
+        copy = sqlite3.connect(str(target))
+        try:
+            with self._lock:
+                self.connection.backup(copy)
+        finally:
+            copy.close()
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class SQLiteStorage:
+    """Storage backend (see aids.app.storage) that keeps a container in an
+    ArchiveDatabase. Both save and checkpoint only write what changed."""
+
+    suffix = ".sqlite3"
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._database = None
+        self._read = 0
+        self._total = 0
+
+    @property
+    def database(self) -> ArchiveDatabase:
+        if self._database is None:
+            self._database = ArchiveDatabase(self.path)
+        return self._database
+
+    def load(self) -> Iterator[Any]:
+        if not self.path.exists():
+            raise FileNotFoundError(f"{self.path} does not exist")
+        self._total = len(self.database)
+        for self._read, value in enumerate(self.database.values(), 1):
+            yield value
+
+    def progress(self) -> int:
+        """Percentage of the objects read by load so far."""
+        return 100 * self._read // max(self._total, 1)
+
+    def checkpoint(self, container):
+        dirty, container.dirty = container.dirty, {}
+        self.database.add_many(
+            (key, container[key]) for key in dirty if key in container
+        )
+        self.database.delete_many(key for key in dirty if key not in container)
+
+    def save(self, container):
+        """Make the database hold the same objects as the container."""
+        container.dirty.update(
+            dict.fromkeys(key for key in self.database if key not in container)
+        )
+        self.checkpoint(container)
+
+    def backup(self, target: Union[str, Path]):
+        self.database.backup(target)
@@ -0,0 +1,87 @@
+"""
+Manifests of the converters: which sources were converted, and into what, the
+last time. The next run only converts the sources that changed since.
+
+A source file is unchanged if its size and modification time are the same --
+or, when they are not, if its content hash still is. The manifest also remembers
+the state of the output it was saved with: an output that was modified by
+anything else does not match it anymore, and everything is converted again.
+
+The sources that are not files -- such as the scenarios of an archive -- are
+known by the hash of their content instead, see content_hash.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+from aids.app.backups import file_hash
+from aids.app.records import encode
+
+
+def content_hash(obj: Any) -> str:
+    """Hash of a JSON object, the same whatever the order of its keys."""
+    text = json.dumps(obj, sort_keys=True, default=encode)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_state(path: Union[str, Path]) -> Optional[Dict[str, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class Manifest:
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        # source -> what is known about it: its state, hash and output
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.output: Optional[Dict[str, int]] = None
+
+    def load(self, output: Optional[Union[str, Path]] = None) -> bool:
+        """Read the manifest. False, and an empty manifest, if there is none or
+        `output` changed after the manifest was saved."""
+        try:
+            with open(self.path) as file:
+                manifest = json.load(file)
+            self.entries, self.output = manifest["entries"], manifest["output"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            self.entries, self.output = {}, None
+            return False
+        if output is not None and (
+            self.output is None or self.output != file_state(output)
+        ):
+            self.entries, self.output = {}, None
+            return False
+        return True
+
+    def save(self, output: Optional[Union[str, Path]] = None):
+        self.output = file_state(output) if output is not None else None
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump({"output": self.output, "entries": self.entries}, file)
+        os.replace(tmp_path, self.path)
+
+    def unchanged(self, source: Union[str, Path]) -> bool:
+        """Whether source is the same as when it was last converted. The
+        entry of a changed source is updated, except for its output."""
+        state = file_state(source)
+        entry = self.entries.setdefault(str(source), {})
+        if entry.get("state") == state:
+            return True
+        digest = file_hash(source)
+        unchanged = entry.get("hash") == digest
+        entry.update(state=state, hash=digest)
+        return unchanged
+
+
+def same_file(path: Union[str, Path], state: Optional[Dict], digest: str) -> bool:
+    """Whether the file at path still is the one with that state and hash."""
+    current = file_state(path)
+    if current is None:
+        return False
+    return current == state or file_hash(path) == digest
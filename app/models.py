@@ -1,14 +1,17 @@
-import os
-import glob
 from pathlib import Path
 from abc import ABC, abstractmethod
 from collections.abc import MutableMapping
 import json
+import copy
 import uuid
 
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional, Tuple, Type
 
 from aids.app.writelogs import logged
+from aids.app.storage import STORAGE_BACKENDS, backend_for
+from aids.app.backups import BackupStore
+from aids.app import records
+from aids.app.columnar import ActionColumns
 from aids.app import settings
 from aids.app.schemes import AIDStoryScheme, AIDScenScheme, NAIScenScheme
 
@@ -34,15 +37,34 @@ class FieldValueIs:
             )
 
 
+class FieldPath:
+    """Getter of a nested field: FieldPath("story", "fragments")(data) is
+    data["story"]["fragments"]. The keys are known when the path is built,
+    so getting the field is just the lookups -- no expression to evaluate."""
+
+    __slots__ = ("keys",)
+
+    def __init__(self, *keys: str):
+        self.keys: Tuple[str, ...] = keys
+
+    def __call__(self, data):
+        for key in self.keys:
+            data = data[key]
+        return data
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}{self.keys!r}"
+
+
 class FieldLenLargerThan:
-    def __init__(self, field, value):
+    def __init__(self, field: FieldPath, value):
         self.field = field
         self.value = value
 
     def validate(self, data):
         # We need to identify to wich service the data belongs here
         # AID's publicId is unique
-        if (actions := len(eval("data" + self.field))) <= self.value:
+        if (actions := len(self.field(data))) <= self.value:
             raise ValidationError(
                 "Too few actions. It must have been more than "
                 f"{self.value} got {actions}"
@@ -70,6 +92,8 @@ class AIDSObject(ABC, dict):
 
     data: Dict
     validators: List
+    # compact version of the objects, see aids.app.records
+    record_class: Optional[Type[records.Record]] = None
 
     def __init__(self):
         super().__init__()
@@ -77,29 +101,66 @@ class AIDSObject(ABC, dict):
         # notice that - unlike the backup path - this one is relative
         # using the module via commands from another directory will dump
         # the stories to that directory
-        self.default_json_file = f"{self.__class__.__name__.lower()}.json"
+        self.storage_backend = STORAGE_BACKENDS[settings.STORAGE_BACKEND]
+        self.default_json_file = (
+            f"{self.__class__.__name__.lower()}{self.storage_backend.suffix}"
+        )
+        self._storage = None
+        # keys added, replaced or removed since the last checkpoint. A dict
+        # rather than a set to save them in the order they were changed.
+        self.dirty: Dict[Any, None] = {}
+        # store records instead of dicts
+        self.compact = settings.COMPACT_RECORDS
         # right here
         self.default_scenario_path = Path().cwd()
         self.unique_indendifier = str(uuid.uuid4())
-        self.default_backups_file = (
-            BASE_DIR
-            / "backups"
-            / f"{self.__class__.__name__.lower()}_{self.unique_indendifier}.json"
-        )
+        self.backups = BackupStore()
 
     def __len__(self):
         return len(self.keys())
 
+    @property
+    def storage(self):
+        """The storage of the file at default_json_file. The extension of the
+        file decides which one, the configured backend if it is not known."""
+        if self._storage is None or self._storage.path != Path(self.default_json_file):
+            self._storage = backend_for(self.default_json_file, self.storage_backend)
+        return self._storage
+
+    def _project(self, value: dict) -> dict:
+        """The value with the keys of the scheme -- and only those. The missing
+        ones take the scheme's default. It is the only copy made of the value
+        and the scheme itself is never modified, so objects can be added from
+        several threads at once. Records are read-only, so they are turned
+        back into dicts first -- options and all."""
+        if isinstance(value, records.Record):
+            value = value.to_dict()
+        return {
+            key: value[key] if key in value else copy.deepcopy(default)
+            for key, default in self.data.items()
+        }
+
     def __setitem__(self, key, value):
-        self.data.update(value)
-        self.clean_titles(self.data)
+        data = self.clean_titles(self._project(value))
         try:
             for validator in self._validators():
-                validator.validate(self.data)
+                validator.validate(data)
         except ValidationError as exc:
             raise ValidationError from exc
         else:
-            super().__setitem__(key, self.data.copy())
+            if self.compact and self.record_class:
+                data = self.record_class.from_dict(data)
+            super().__setitem__(key, data)
+            self.dirty[key] = None
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty[key] = None
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty[key] = None
+        return super().pop(key, *default)
 
     def update(self, other=(), /, **kwds):
         # The builtin dict.update method
@@ -122,46 +183,69 @@ class AIDSObject(ABC, dict):
 
     def dump(self):
         try:
-            with open(self.default_json_file, "w") as file:
-                json.dump(tuple(self.values()), file)
-            # check if there are too many backups
-            backup_files = glob.glob(str(self.default_backups_file.parent / "*.json"))
-            if len(backup_files) > 100:
-                # remove the last files
-                for file in backup_files[99:]:
-                    os.remove(file)
-            with open(self.default_backups_file, "w") as file:
-                json.dump(tuple(self.values()), file)
-        except json.decoder.JSONDecodeError:
+            self.storage.save(self)
+            # by absolute path: archives of the same name in different
+            # directories are different archives
+            self.backups.add(self.storage, str(self.storage.path.resolve()))
+        except (json.decoder.JSONDecodeError, TypeError):
             validated_data = self.values() if len(self) < 2 else list(self.keys())
             self.logger_err.error(
                 "Error while dumping the data. Validated data: %s", validated_data
             )
         self.logger.info("Dumped all data to %s", self.default_json_file)
 
+    def checkpoint(self):
+        """Save what changed since the last checkpoint, if the storage can do it
+        cheaply. Meant to be called after every object of a long download."""
+        try:
+            self.storage.checkpoint(self)
+        except TypeError:
+            self.logger_err.error("Error while saving a checkpoint.")
+
     def load(self):
-        """Load data form a json file."""
+        """Load data form the storage file. The objects are parsed and validated
+        one at a time, so the whole file is never held in memory."""
+        storage = self.storage
+        name = self.default_json_file
         try:
-            with open(self.default_json_file) as file:
-                raw_data = json.load(file)
-            self.logger.info(
-                "Loading data... %d objects found, proceeding to validate.",
-                len(raw_data),
-            )
-            if not isinstance(raw_data, List):
-                raise TypeError(
-                    f"Error while parsing the data. {file.name} json data is not "
-                    f"correctly formatted. {self.__class__.__name__}s must be placed "
-                    "in an array (or list)."
-                )
-            for scenario in raw_data:
-                self.add(scenario)
-        except json.decoder.JSONDecodeError:
+            self.logger.info("Loading data from %s...", name)
+            for number, value in enumerate(storage.load(), 1):
+                try:
+                    self.add(value)
+                except (KeyError, TypeError, AttributeError) as exc:
+                    self.logger_err.error(
+                        "Object number %d of %s is malformed, skipping it: %r",
+                        number,
+                        name,
+                        exc,
+                    )
+                if number % settings.LOAD_PROGRESS_EVERY == 0:
+                    self.logger.info(
+                        "%d objects read (%d%%)...", number, storage.progress()
+                    )
+        except TypeError as exc:
+            raise TypeError(
+                f"Error while parsing the data. {name} json data is not "
+                f"correctly formatted. {self.__class__.__name__}s must be placed "
+                "in an array (or list)."
+            ) from exc
+        except json.decoder.JSONDecodeError as exc:
             self.logger_err.error(
-                "Error while loading the data. %s does not contain valid JSON.",
-                file.name,
+                "Error while loading the data. %s does not contain valid JSON: %s",
+                name,
+                exc,
             )
-        self.logger.info("%d objects loaded from the %s", len(self), file.name)
+        # what is in the file is not a change
+        self.dirty.clear()
+        self.logger.info("%d objects loaded from the %s", len(self), name)
+
+    def index(self) -> Dict[str, Tuple[Any, str]]:
+        """publicId -> (key, updatedAt) of every stored object that has a publicId."""
+        return {
+            value["publicId"]: (key, value.get("updatedAt"))
+            for key, value in self.items()
+            if value.get("publicId")
+        }
 
     @abstractmethod
     def _validators(self) -> List[Any]:
@@ -222,12 +306,11 @@ class BaseStory(AIDSObject):
     """
 
     # The action_field attribute is
-    # a string that is meant to be passed to eval to get the action
-    # objects from the data.
+    # the path to the action objects in the data.
     title: str = settings.DEFAULT_TITLE
     actions: int = settings.DEFAULT_MIN_ACT
 
-    action_field: str = '["actions"]'
+    action_field: FieldPath = FieldPath("actions")
 
     def __init__(self, title: str = "", actions: int = 0):
         super().__init__()
@@ -239,8 +322,13 @@ class BaseStory(AIDSObject):
         self.title = title
         self.actions = actions
 
+    def to_columns(self) -> ActionColumns:
+        """The actions of all the stories in a columnar store, to be scanned
+        or saved without a Python object per action. See aids.app.columnar."""
+        return ActionColumns.from_stories(self.values())
+
     def _add(self, value: dict):
-        key = (value["title"], len(eval("value" + self.action_field)))
+        key = (value["title"], len(self.action_field(value)))
         self.__setitem__(key, value)
 
     def _validators(self):
@@ -256,19 +344,21 @@ class Scenario(BaseScenario):
     """AID Scenario model container."""
 
     data = AIDScenScheme
+    record_class = records.Scenario
 
 
 class Story(BaseStory):
     """AID Story model container"""
 
     data = AIDStoryScheme
+    record_class = records.Story
 
 
 class NAIScenario(BaseScenario):
     """NAI scenario model container"""
 
     data = NAIScenScheme
-    action_field = '["story"]["fragments"]'
+    action_field = FieldPath("story", "fragments")
 
     def dump_single_files(self):
         for scenario in self.values():
@@ -0,0 +1,50 @@
+"""
+Process pools for the converters. The objects are streamed through the pool:
+only a bounded number of them are waiting to be converted or written at any
+time, so the memory used does not grow with the size of the archive.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Deque, Iterable, Iterator, Optional
+
+from aids.app import settings
+
+
+def worker_count(workers: Optional[int], default: Optional[int] = None) -> int:
+    """`workers` or, if it is None, `default` -- the setting of the caller.
+    None means one process per core."""
+    if workers is None:
+        workers = default
+    return workers or os.cpu_count() or 1
+
+
+def imap_bounded(
+    function: Callable[[Any], Any],
+    items: Iterable[Any],
+    workers: int,
+    queue_size: int = settings.CONVERT_QUEUE_SIZE,
+) -> Iterator[Any]:
+    """
+    function(item) for every item, in the order of the items, computed by
+    `workers` processes (see worker_count). At most queue_size items per
+    process are taken from `items` before their results are consumed.
+    function must be picklable -- defined at the top level of a module.
+    With a single worker everything runs in this process.
+    """
+    if workers == 1:
+        yield from map(function, items)
+        return
+    pending: Deque = deque()
+    with ProcessPoolExecutor(workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= workers * queue_size:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,161 @@
+"""
+Random access to the objects of a JSON archive -- such as story.json -- without
+loading it. A sidecar index (story.json.idx) holds where every object starts
+and ends in the file, with its publicId, title and number of actions. The
+archive is memory-mapped and only the objects asked for are decoded:
+
+    with ArchiveReader("story.json") as stories:
+        story = stories["4895748458"]
+        duty_calls = stories.by_title("Duty Calls")
+
+The index is built the first time the archive is opened, and again whenever
+the archive changes.
+"""
+
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from aids.app.storage import iter_json_array
+from aids.app.writelogs import logged
+
+# start, end, publicId, title, actions
+Entry = Tuple[int, int, Optional[str], Optional[str], Optional[int]]
+
+
+def _entry(value: Any, start: int, end: int) -> Entry:
+    if not isinstance(value, dict):
+        return (start, end, None, None, None)
+    actions = value.get("actions")
+    return (
+        start,
+        end,
+        value.get("publicId"),
+        value.get("title"),
+        len(actions) if isinstance(actions, list) else None,
+    )
+
+
+@logged
+class ArchiveReader:
+    """Read-only view of a JSON archive, see the module documentation. Keep
+    it open while reading: the objects are decoded from the mapped file."""
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        index_path: Optional[Union[str, Path]] = None,
+    ):
+        self.path = Path(path)
+        self.index_path = (
+            Path(index_path)
+            if index_path
+            else self.path.with_name(self.path.name + ".idx")
+        )
+        self.entries: List[Entry] = []
+        self._public_ids: Dict[str, int] = {}
+        self._titles: Dict[str, List[int]] = {}
+        self._buffer: Optional[mmap.mmap] = None
+        self._open()
+
+    def _open(self):
+        with open(self.path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            if not self._read_index(stat):
+                self.logger.info("Indexing %s...", self.path)
+                self.entries = [
+                    _entry(value, start, end)
+                    for value, start, end in iter_json_array(file, spans=True)
+                ]
+                self._write_index(stat)
+            # an empty file can not be mapped
+            if stat.st_size:
+                self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        for number, (_, _, public_id, title, _) in enumerate(self.entries):
+            if public_id is not None:
+                self._public_ids.setdefault(public_id, number)
+            if title is not None:
+                self._titles.setdefault(title, []).append(number)
+
+    def _read_index(self, stat: os.stat_result) -> bool:
+        """Use the sidecar index if it was built for this very file."""
+        try:
+            with open(self.index_path) as file:
+                index = json.load(file)
+            if (index["size"], index["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+                return False
+            self.entries = [tuple(entry) for entry in index["entries"]]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def _write_index(self, stat: os.stat_result):
+        index = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "entries": self.entries,
+        }
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.tmp")
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(index, file)
+            os.replace(tmp_path, self.index_path)
+        except OSError as exc:
+            # a read-only directory, the index is rebuilt next time
+            self.logger_err.error("Could not write %s: %s", self.index_path, exc)
+
+    # --- reading ---
+    def _decode(self, number: int) -> Any:
+        start, end = self.entries[number][:2]
+        return json.loads(self._buffer[start:end])
+
+    def get(self, public_id: str, default: Any = None) -> Any:
+        """The object with that publicId."""
+        number = self._public_ids.get(public_id)
+        return default if number is None else self._decode(number)
+
+    def by_title(self, title: str, actions: Optional[int] = None) -> List[Any]:
+        """The objects with that title -- and number of actions, if given."""
+        return [
+            self._decode(number)
+            for number in self._titles.get(title, ())
+            if actions is None or self.entries[number][4] == actions
+        ]
+
+    def __getitem__(self, key) -> Any:
+        """A publicId, or a (title, actions) story key."""
+        if isinstance(key, tuple):
+            found = self.by_title(*key)
+            if found:
+                return found[0]
+        elif key in self._public_ids:
+            return self._decode(self._public_ids[key])
+        raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        if isinstance(key, tuple):
+            title, actions = key
+            return any(
+                self.entries[number][4] == actions
+                for number in self._titles.get(title, ())
+            )
+        return key in self._public_ids
+
+    def __iter__(self) -> Iterator[Any]:
+        return (self._decode(number) for number in range(len(self)))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def close(self):
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,249 @@
+"""
+Compact versions of the objects stored by the containers. A record keeps the
+known fields in __slots__ instead of a dict per object, which is most of the
+memory of an archive made of millions of actions. Unknown fields go to
+`_extra` and the original order of the keys is kept (and shared between the
+records with the same keys), so to_dict gives back exactly the dict that was
+passed to from_dict.
+
+The texts are the same strings either way, so the saving depends on how much
+of an archive they are: records take about half the memory of the dicts for
+short actions, and a third less for whole stories. aids.app.columnar goes
+further for the actions.
+
+Records can be read like the dicts they stand for -- record["title"],
+record.get("actions"), dict(record) -- so most of the code does not need to
+know which one it got.
+"""
+
+import collections.abc
+import datetime
+import sys
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+# the same tuple of keys for every record with the same layout
+_layouts: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+ACTION_TYPES = tuple(sys.intern(type_) for type_ in ("story", "continue", "do", "say"))
+
+
+def _layout(keys: Tuple[str, ...]) -> Tuple[str, ...]:
+    return _layouts.setdefault(keys, keys)
+
+
+# Packed fields are kept as an int when the int gives back the very same
+# string -- an id such as "4895748458" or a timestamp such as
+# "2021-05-14T03:56:09.539Z" -- and as they came otherwise.
+def _pack_digits(value: Any) -> Optional[int]:
+    if (
+        isinstance(value, str)
+        and value.isascii()
+        and value.isdigit()
+        and (value == "0" or value[0] != "0")
+    ):
+        return int(value)
+    return None
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+def _unpack_timestamp(value: int) -> str:
+    moment = _EPOCH + value * _MILLISECOND
+    return moment.isoformat(timespec="milliseconds") + "Z"
+
+
+def _pack_timestamp(value: Any) -> Optional[int]:
+    if not (isinstance(value, str) and len(value) == 24 and value[-1] == "Z"):
+        return None
+    try:
+        packed = (datetime.datetime.fromisoformat(value[:-1]) - _EPOCH) // _MILLISECOND
+    except ValueError:
+        return None
+    return packed if _unpack_timestamp(packed) == value else None
+
+
+DIGITS = (_pack_digits, str)
+TIMESTAMP = (_pack_timestamp, _unpack_timestamp)
+
+
+class Record:
+    __slots__ = ("_keys", "_extra")
+
+    fields: Tuple[str, ...] = ()
+    # slot of the fields whose name is taken by a method
+    slots: Dict[str, str] = {}
+    # fields holding a list of records of that class
+    nested: Dict[str, type] = {}
+    # string fields with a handful of values, stored once
+    interned: Tuple[str, ...] = ()
+    # fields stored as ints when possible, with their (pack, unpack) functions
+    packed: Dict[str, Tuple[Callable, Callable]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.fields)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Record":
+        if isinstance(data, cls):
+            return data
+        record = cls.__new__(cls)
+        extra: Optional[Dict[str, Any]] = None
+        for key, value in data.items():
+            if key not in cls._field_set:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+                continue
+            if key in cls.packed:
+                packed = cls.packed[key][0](value)
+                if packed is not None:
+                    value = packed
+                elif type(value) is int:
+                    # would be taken for a packed value
+                    if extra is None:
+                        extra = {}
+                    extra[key] = value
+                    continue
+            elif key in cls.nested and isinstance(value, list):
+                record_class = cls.nested[key]
+                value = [
+                    record_class.from_dict(item) if isinstance(item, dict) else item
+                    for item in value
+                ]
+            elif key in cls.interned and isinstance(value, str):
+                value = sys.intern(value)
+            object.__setattr__(record, cls.slots.get(key, key), value)
+        record._keys = _layout(tuple(data.keys()))
+        record._extra = extra
+        return record
+
+    def _value(self, key: str) -> Any:
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        value = getattr(self, self.slots.get(key, key))
+        if type(value) is int and key in self.packed:
+            return self.packed[key][1](value)
+        return value
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {}
+        for key in self._keys:
+            value = self._value(key)
+            if key in self.nested and isinstance(value, list):
+                value = [
+                    item.to_dict() if isinstance(item, Record) else item
+                    for item in value
+                ]
+            data[key] = value
+        return data
+
+    # --- read like a dict ---
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._keys:
+            raise KeyError(key)
+        return self._value(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._value(key) if key in self._keys else default
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def keys(self) -> Tuple[str, ...]:
+        return self._keys
+
+    def values(self) -> Iterator[Any]:
+        return (self._value(key) for key in self._keys)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return ((key, self._value(key)) for key in self._keys)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Record):
+            other = other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.to_dict()!r})"
+
+
+class Action(Record):
+    fields = ("id", "text", "type", "createdAt")
+    __slots__ = fields
+    interned = ("type",)
+    packed = {"id": DIGITS, "createdAt": TIMESTAMP}
+
+
+class WorldInfoEntry(Record):
+    fields = ("id", "keys", "entry")
+    __slots__ = ("id", "keys_", "entry")
+    slots = {"keys": "keys_"}
+    packed = {"id": DIGITS}
+
+
+class Story(Record):
+    fields = (
+        "title",
+        "description",
+        "tags",
+        "createdAt",
+        "updatedAt",
+        "publicId",
+        "authorsNote",
+        "worldInfo",
+        "actions",
+        "undoneWindow",
+    )
+    __slots__ = fields
+    nested = {"worldInfo": WorldInfoEntry, "actions": Action, "undoneWindow": Action}
+
+
+class Scenario(Record):
+    fields = (
+        "title",
+        "description",
+        "tags",
+        "createdAt",
+        "updatedAt",
+        "publicId",
+        "prompt",
+        "memory",
+        "authorsNote",
+        "worldInfo",
+        "isOption",
+        "gameCode",
+        "options",
+        "nsfw",
+    )
+    __slots__ = fields
+    nested = {"worldInfo": WorldInfoEntry}
+
+
+# records are read-only mappings
+collections.abc.Mapping.register(Record)
+
+# the options of a scenario are (references to) scenarios
+Scenario.nested["options"] = Scenario
+
+
+def encode(obj: Any) -> Any:
+    """`default` for json.dump: records are written as their dicts, other
+    sequences (such as the actions of aids.app.columnar) as lists."""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    if isinstance(obj, collections.abc.Sequence):
+        return list(obj)
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
@@ -24,11 +24,98 @@ DEBUG = True
 # performed to the models.
 DEFAULT_TITLE = ""
 DEFAULT_MIN_ACT = 10
-
-try:
-    os.mkdir(BASE_DIR / "backups")
-except FileExistsError:
-    pass
+# the archives are parsed one object at a time. Log the progress every
+# that many objects.
+LOAD_PROGRESS_EVERY = 10000
+# how the containers are saved. "json" rewrites one JSON array on every dump,
+# "jsonl" appends the changed objects to a JSON Lines file and compacts it
+# once more than STORAGE_COMPACT_RATIO of its lines are outdated. "sqlite"
+# keeps them in an indexed SQLite database, written DATABASE_BATCH_SIZE
+# objects per transaction. "columnar" (stories only) saves the actions in
+# flat arrays that are memory-mapped when loaded.
+STORAGE_BACKEND = "json"
+STORAGE_COMPACT_RATIO = 0.5
+DATABASE_BATCH_SIZE = 500
+# keep the stories and scenarios in memory as the compact records of
+# aids.app.records instead of dicts. They read like dicts and are saved the
+# same way, but take a third to a half less memory -- the texts are the
+# same. See the columnar store (".columns" archives) for more.
+COMPACT_RECORDS = False
+# every dump leaves a backup of the archive in BACKUP_DIR. Identical archives
+# are stored once. The newest BACKUP_KEEP backups of each archive are kept,
+# and those older than BACKUP_MAX_AGE seconds (None for any age) are removed
+# -- except the newest one. BACKUP_COMPRESS gzips them.
+BACKUP_DIR = BASE_DIR / "backups"
+BACKUP_KEEP = 100
+BACKUP_MAX_AGE = None
+BACKUP_COMPRESS = False
+# processes used by the converters (makenai...). None means one per core.
+# At most CONVERT_QUEUE_SIZE objects per process are waiting to be written.
+CONVERT_WORKERS = None
+CONVERT_QUEUE_SIZE = 4
+# alltohtml only renders the pages whose object or templates changed since
+# the last time, and removes those of the objects that are gone
+HTML_INCREMENTAL = True
+# processes rendering the stories to html, HTML_BATCH_SIZE stories at a time.
+# None means one per core.
+HTML_WORKERS = 1
+HTML_BATCH_SIZE = 8
+# the templates are compiled once and their bytecode cached here. With
+# PRECOMPILED_TEMPLATES they are not even parsed: the modules written to
+# COMPILED_TEMPLATES_DIR by the compiletemplates command are used instead.
+TEMPLATE_CACHE_DIR = BASE_DIR / "templates_cache"
+PRECOMPILED_TEMPLATES = False
+COMPILED_TEMPLATES_DIR = BASE_DIR / "templates_compiled"
+
+## Client settings
+# number of objects downloaded at the same time. 1 means one after the other.
+DEFAULT_WORKERS = 1
+# send independent queries (such as a scenario and its world info) in one request
+BATCH_QUERIES = True
+# failed requests are retried with exponential backoff. The wait doubles
+# from RETRY_BACKOFF up to RETRY_MAX_BACKOFF seconds until RETRY_MAX_ATTEMPTS
+# attempts or RETRY_BUDGET seconds have been spent on the request.
+RETRY_MAX_ATTEMPTS = 8
+RETRY_BACKOFF = 1
+RETRY_MAX_BACKOFF = 60
+RETRY_BUDGET = 600
+# status codes that mean "try again later" instead of a failure
+RETRY_STATUSES = (429, 502, 503, 504)
+# requests per second allowed for each host, None for no limit. Shared by all
+# the clients and threads of the process. It is lowered automatically when the
+# server answers with 429 (Too Many Requests) and slowly recovers afterwards.
+# A host without a limit is slowed down from THROTTLED_RATE_LIMIT after a
+# 429, and the limit is lifted when its rate recovered back to it.
+DEFAULT_RATE_LIMIT = None
+THROTTLED_RATE_LIMIT = 5
+RATE_LIMITS = {
+    "prompts.aidg.club": 1,
+}
+# connection pools. They are shared by all the clients pointing to the same host
+# and grow to match the number of workers. "http2" needs httpx[http2].
+HTTP_BACKEND = "requests"
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+# wait for a free connection instead of opening (and discarding) an extra one
+POOL_BLOCK = False
+# seconds to wait for a connection, or for the next bytes of an answer, before
+# giving up on the request (and retrying it if possible)
+REQUEST_TIMEOUT = 60
+# downloaded objects are cached on disk. Stories and scenarios are reused
+# while their updatedAt does not change, everything else for CACHE_TTL seconds.
+# The least recently used responses are dropped past CACHE_MAX_SIZE bytes.
+CACHE_ENABLED = True
+CACHE_DIR = BASE_DIR / "cache"
+CACHE_TTL = 24 * 60 * 60
+CACHE_MAX_SIZE = 1024**3
+# unfinished scenario crawls are saved here to be resumed later
+CRAWL_DIR = BASE_DIR / "crawls"
+
+for directory in (BACKUP_DIR, CRAWL_DIR, CACHE_DIR):
+    try:
+        os.mkdir(directory)
+    except FileExistsError:
+        pass
 
 # Secrets
 secrets_form = {
@@ -0,0 +1,390 @@
+import codecs
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Dict, IO, Iterable, Iterator, Union
+
+from aids.app.columnar import ColumnarStorage
+from aids.app.database import SQLiteStorage
+from aids.app.records import encode
+from aids.app.writelogs import logged
+from aids.app import settings
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def dump_json_array(values: Iterable[Any], path: Union[str, Path]):
+    """
+    Write the values as a JSON array, one object at a time, so the whole
+    array is never built in memory. The data goes to a temporary file that
+    replaces `path` only once it is complete -- a crash in the middle leaves
+    the previous file untouched.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "w") as file:
+            file.write("[")
+            for number, value in enumerate(values):
+                if number:
+                    file.write(", ")
+                file.write(json.dumps(value, default=encode))
+            file.write("]")
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            os.remove(tmp_path)
+
+
+def copy_file(source: Union[str, Path], target: Union[str, Path]):
+    """
+    Make target a copy of source. A hard link when the filesystem allows it,
+    which is safe because the files written by dump_json_array are replaced,
+    never modified in place.
+    """
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _utf8_size(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+
+def iter_json_array(
+    file: IO, chunk_size: int = 2**16, spans: bool = False
+) -> Iterator[Any]:
+    """
+    Yield the items of the JSON array in `file` one by one. Only the item
+    being parsed is kept in memory, so the size of the file does not matter.
+    Raises TypeError if the file does not hold an array and
+    json.JSONDecodeError if it is not valid JSON -- the items before the
+    error have been yielded by then.
+
+    With spans=True the file must be opened in binary mode, and the items
+    come as (item, start, end) tuples: where the item is in the file, in bytes.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")() if spans else None
+    buffer, pos, eof = "", 0, False
+    # byte offset in the file of buffer[mark]
+    mark, mark_offset = 0, 0
+    # what comes next: "[", the "first" item (or "]"), "," (or "]") or a "value"
+    expecting = "["
+    needs_more = False
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if needs_more or pos == len(buffer):
+            if eof:
+                raise json.JSONDecodeError("Unexpected end of data", buffer, pos)
+            # read at least as much as it is left, so an item larger than
+            # the chunk size is not decoded over and over again
+            chunk = file.read(max(chunk_size, len(buffer) - pos))
+            eof = not chunk
+            if spans:
+                mark_offset += _utf8_size(buffer[mark:pos])
+                mark = 0
+                chunk = utf8.decode(chunk, final=eof)
+            buffer, pos = buffer[pos:] + chunk, 0
+            needs_more = False
+            continue
+
+        char = buffer[pos]
+        if expecting == "[":
+            if char != "[":
+                raise TypeError("The JSON data is not an array.")
+            pos += 1
+            expecting = "first"
+        elif expecting in ("first", ",") and char == "]":
+            return
+        elif expecting == ",":
+            if char != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+            pos += 1
+            expecting = "value"
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                needs_more = True
+                continue
+            # a number could go on in the next chunk
+            if end == len(buffer) and not eof:
+                needs_more = True
+                continue
+            if spans:
+                start = mark_offset + _utf8_size(buffer[mark:pos])
+                mark, mark_offset = end, start + _utf8_size(buffer[pos:end])
+                yield value, start, mark_offset
+            else:
+                yield value
+            pos = end
+            expecting = ","
+
+
+class JSONStorage:
+    """
+    The whole container as one JSON array, rewritten by every save.
+    checkpoint does nothing -- it would rewrite the whole file every time.
+    """
+
+    suffix = ".json"
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = None
+        self._size = 0
+
+    def load(self) -> Iterator[Any]:
+        with open(self.path) as self._file:
+            self._size = os.fstat(self._file.fileno()).st_size
+            yield from iter_json_array(self._file)
+
+    def progress(self) -> int:
+        """Percentage of the file read by load so far."""
+        return 100 * self._file.tell() // max(self._size, 1)
+
+    def save(self, container):
+        dump_json_array(container.values(), self.path)
+        container.dirty.clear()
+
+    def checkpoint(self, container):
+        pass
+
+    def backup(self, target: Union[str, Path]):
+        copy_file(self.path, target)
+
+
+def _encode_key(key):
+    # story keys are (title, actions) tuples, which JSON turns into lists
+    return list(key) if isinstance(key, tuple) else key
+
+
+def _decode_key(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+@logged
+class JSONLinesStorage:
+    """
+    Append-only JSON Lines log. Each line is either {"key": ..., "value": ...}
+    or {"key": ..., "deleted": true} and the last line of a key wins, so a
+    checkpoint only appends the objects that changed since the previous one.
+    The file is compacted -- rewritten with the live lines only -- when more
+    than `compact_ratio` of its lines are stale.
+
+    The byte offset of the live line of every key is kept in memory and in a
+    sidecar index file, written on save. Only the lines appended after the
+    index was written are read again when the file is opened.
+    """
+
+    suffix = ".jsonl"
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        compact_ratio: float = settings.STORAGE_COMPACT_RATIO,
+    ):
+        self.path = Path(path)
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        self.compact_ratio = compact_ratio
+        self.offsets: Dict[Any, int] = {}
+        self.lines = 0
+        self._indexed = False
+        self._position = 0
+        self._lock = threading.RLock()
+
+    @property
+    def stale(self) -> int:
+        return self.lines - len(self.offsets)
+
+    def _index(self):
+        """Read the sidecar index, then the lines appended after it."""
+        if self._indexed:
+            return
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        start = 0
+        try:
+            with open(self.index_path) as file:
+                index = json.load(file)
+            if index["size"] <= size:
+                self.offsets = {_decode_key(key): off for key, off in index["offsets"]}
+                self.lines = index["lines"]
+                start = index["size"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            self.offsets, self.lines = {}, 0
+        if start < size:
+            self._scan(start, size)
+        self._indexed = True
+
+    def _scan(self, offset: int, size: int):
+        with open(self.path, "rb+") as file:
+            file.seek(offset)
+            for line in iter(file.readline, b""):
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete line")
+                    record = json.loads(line)
+                    key = _decode_key(record["key"])
+                except (ValueError, KeyError, TypeError):
+                    if offset + len(line) >= size:
+                        # the last write was interrupted, drop what is left of it
+                        self.logger_err.error(
+                            "Dropping the incomplete last line of %s", self.path
+                        )
+                        file.truncate(offset)
+                        break
+                    self.logger_err.error(
+                        "Skipping the malformed line at byte %d of %s",
+                        offset,
+                        self.path,
+                    )
+                else:
+                    self._apply(key, record, offset)
+                self.lines += 1
+                offset += len(line)
+
+    def _apply(self, key, record: Dict[str, Any], offset: int):
+        if record.get("deleted"):
+            self.offsets.pop(key, None)
+        else:
+            self.offsets[key] = offset
+
+    def _write_index(self):
+        index = {
+            "size": self.path.stat().st_size,
+            "lines": self.lines,
+            "offsets": [[_encode_key(key), off] for key, off in self.offsets.items()],
+        }
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(index, file)
+        os.replace(tmp_path, self.index_path)
+
+    def load(self) -> Iterator[Any]:
+        with self._lock:
+            self._index()
+            offsets = sorted(self.offsets.values())
+        with open(self.path, "rb") as file:
+            for self._position in offsets:
+                file.seek(self._position)
+                yield json.loads(file.readline())["value"]
+
+    def progress(self) -> int:
+        """Percentage of the file read by load so far."""
+        try:
+            return 100 * self._position // max(self.path.stat().st_size, 1)
+        except FileNotFoundError:
+            return 100
+
+    def get(self, key) -> Any:
+        """Read a single object without loading the rest."""
+        with self._lock:
+            self._index()
+            offset = self.offsets[key]
+            with open(self.path, "rb") as file:
+                file.seek(offset)
+                return json.loads(file.readline())["value"]
+
+    def _append(self, records: Iterable[Dict[str, Any]]):
+        with open(self.path, "ab") as file:
+            for record in records:
+                offset = file.tell()
+                file.write(json.dumps(record, default=encode).encode() + b"\n")
+                self._apply(_decode_key(record["key"]), record, offset)
+                self.lines += 1
+            file.flush()
+            os.fsync(file.fileno())
+
+    def checkpoint(self, container):
+        """Append the objects added, replaced or removed since the last call."""
+        with self._lock:
+            self._index()
+            dirty, container.dirty = container.dirty, {}
+            self._append(
+                (
+                    {"key": _encode_key(key), "value": container[key]}
+                    if key in container
+                    else {"key": _encode_key(key), "deleted": True}
+                )
+                for key in dirty
+                if key in container or key in self.offsets
+            )
+
+    def save(self, container):
+        """Make the file hold the same objects as the container."""
+        with self._lock:
+            self._index()
+            container.dirty.update(
+                dict.fromkeys(key for key in self.offsets if key not in container)
+            )
+            self.checkpoint(container)
+            if self.stale > self.compact_ratio * self.lines:
+                self.compact()
+            else:
+                self._write_index()
+
+    def compact(self):
+        with self._lock:
+            self._index()
+            tmp_path = self.path.with_name(f".{self.path.name}.{uuid.uuid4().hex}.tmp")
+            offsets = {}
+            try:
+                with open(self.path, "rb") as source, open(tmp_path, "wb") as target:
+                    for key, offset in sorted(
+                        self.offsets.items(), key=lambda item: item[1]
+                    ):
+                        source.seek(offset)
+                        offsets[key] = target.tell()
+                        target.write(source.readline())
+                    target.flush()
+                    os.fsync(target.fileno())
+                os.replace(tmp_path, self.path)
+            finally:
+                if tmp_path.exists():
+                    os.remove(tmp_path)
+            self.logger.info(
+                "Compacted %s: %d stale lines dropped", self.path, self.stale
+            )
+            self.offsets, self.lines = offsets, len(offsets)
+            self._write_index()
+
+    def backup(self, target: Union[str, Path]):
+        # no hard link, the file is appended to in place
+        shutil.copyfile(self.path, target)
+
+
+STORAGE_BACKENDS = {
+    "json": JSONStorage,
+    "jsonl": JSONLinesStorage,
+    "sqlite": SQLiteStorage,
+    "columnar": ColumnarStorage,
+}
+
+
+def backend_for(path: Union[str, Path], default=JSONStorage):
+    """The storage of a file, chosen by its extension."""
+    path = Path(path)
+    for backend in STORAGE_BACKENDS.values():
+        if path.suffix == backend.suffix:
+            return backend(path)
+    return default(path)
+
+
+def read_objects(path: Union[str, Path]) -> Iterator[Any]:
+    """Every object saved in the file, whatever its storage."""
+    return backend_for(path).load()
@@ -1,22 +1,67 @@
 import os
+import asyncio
+import functools
 import glob
 import json
+import tempfile
+import time
+import tracemalloc
 import unittest
 import unittest.mock
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from unittest import skip
 
 import requests
 from bs4 import BeautifulSoup as bs
 
 import aids.app.client
+import aids.commands
 from aids.app.settings import BASE_DIR, ImproperlyConfigured
-from aids.app.client import AIDScrapper
-from aids.app.models import Story, Scenario, ValidationError
+from aids.app.client import AIDScrapper, ClubClient, RetryPolicy, Session
+from aids.app.throttle import RateLimiter, TokenBucket
+from aids.app.transport import HTTP2Adapter, Transport
+from aids.app.cache import ResponseCache
+from aids.app.database import ArchiveDatabase
+from aids.app.backups import BackupStore
+from aids.app.columnar import ActionColumns
+from aids.app.reader import ArchiveReader
+import aids.to_html as to_html
+from aids.app.storage import (
+    dump_json_array,
+    copy_file,
+    iter_json_array,
+    JSONStorage,
+    JSONLinesStorage,
+)
+from aids.app.async_client import AsyncAIDScrapper, httpx
+from aids.app.models import Story, Scenario, ValidationError, FieldPath
+from aids.app import records
 from aids.app.schemes import FrozenKeyDict
 from aids.commands import makejson, makenai, alltohtml
 
 TEST_DIR = BASE_DIR / "app/test_files"
 
+_backup_dir = None
+_backup_patch = None
+
+
+def setUpModule():
+    # the archives dumped by the tests are not backed up with the real ones
+    global _backup_dir, _backup_patch
+    _backup_dir = tempfile.TemporaryDirectory()
+    _backup_patch = unittest.mock.patch(
+        "aids.app.models.BackupStore",
+        functools.partial(BackupStore, Path(_backup_dir.name) / "backups"),
+    )
+    _backup_patch.start()
+
+
+def tearDownModule():
+    _backup_patch.stop()
+    _backup_dir.cleanup()
+
 
 def do_regex(string):
     return f"[{string}]"
@@ -79,6 +124,51 @@ class TestModel(unittest.TestCase):
             ValidationError, self.stories.update, {"sneed": duplicate_scenario}
         )
 
+    def test_no_fields_leak_between_objects(self):
+        first, second = self.stor_in[0], dict(self.stor_in[1])
+        first["authorsNote"] = "sneed"
+        del second["authorsNote"]
+        second["notInTheScheme"] = True
+
+        self.stories.add(first)
+        self.stories.add(second)
+
+        stored = self.stories[second["title"], len(second["actions"])]
+        self.assertEqual(stored["authorsNote"], "")
+        self.assertNotIn("notInTheScheme", stored)
+        self.assertIn("notInTheScheme", second)
+
+    def test_concurrent_adds(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(self.scenarios.add, self.scen_in))
+
+        for scenario in self.scen_in:
+            self.assertEqual(
+                self.scenarios[scenario["title"]]["prompt"], scenario["prompt"]
+            )
+
+    def test_field_path(self):
+        story = self.stor_in[0]
+
+        self.assertIs(FieldPath("actions")(story), story["actions"])
+        self.assertEqual(
+            FieldPath("actions", 0, "text")(story), story["actions"][0]["text"]
+        )
+        self.assertRaises(KeyError, FieldPath("story", "fragments"), story)
+
+    def test_field_path_does_not_eval(self):
+        story = self.stor_in[0]
+
+        with unittest.mock.patch("builtins.eval") as eval_:
+            self.assertEqual(
+                FieldPath("actions", -1, "text")(story), story["actions"][-1]["text"]
+            )
+            self.assertEqual(len(FieldPath("actions")(story)), len(story["actions"]))
+            for validator in self.stories._validators():
+                validator.validate(story)
+
+        eval_.assert_not_called()
+
     def duplicate_story_raises(self):
         duplicate_story = self.stor_in[0]
 
@@ -123,10 +213,15 @@ class TestReformatters(unittest.TestCase):
         for file_path in nai_file_names:
             if str(file_path) != str(self.scenario_infile):
                 os.remove(file_path)
-        try:
-            os.remove(self.json_outfile)
-        except FileNotFoundError:
-            pass
+        for path in (
+            self.json_outfile,
+            Path(f"{self.json_outfile}.manifest"),
+            TEST_DIR / "test_scen.json.makenai.manifest",
+        ):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
         try:
             os.remove(self.scenario_outfile)
         except FileNotFoundError:
@@ -147,6 +242,33 @@ class TestReformatters(unittest.TestCase):
             out_f[0].values(),
         )
 
+    def test_makejson_skips_unchanged_files(self):
+        with open(self.scenario_infile) as file:
+            scenario = json.load(file)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            directory = Path(tmp_dir)
+            for title in ("A", "B", "C"):
+                with open(directory / f"{title}.scenario", "w") as file:
+                    json.dump({**scenario, "title": title}, file)
+            target = directory / "scenario.json"
+            makejson(directory / "*.scenario", target, workers=2)
+
+            with open(directory / "B.scenario", "w") as file:
+                json.dump({**scenario, "title": "D"}, file)
+            os.remove(directory / "C.scenario")
+            with unittest.mock.patch(
+                "aids.commands._read_nai_scenario",
+                side_effect=aids.commands._read_nai_scenario,
+            ) as read:
+                makejson(directory / "*.scenario", target, workers=1)
+
+            read.assert_called_once_with(str(directory / "B.scenario"))
+            with open(target) as file:
+                self.assertEqual(
+                    sorted(scenario["title"] for scenario in json.load(file)),
+                    ["A", "D"],
+                )
+
     def test_makenai(self):
         makenai(self.json_infile, self.scenario_outfile, single_files=False)
 
@@ -176,6 +298,55 @@ class TestReformatters(unittest.TestCase):
 
         assert len(glob.glob(str(TEST_DIR / "*.scenario"))) > 60
 
+    def test_makenai_converts_only_changes(self):
+        with open(self.json_infile) as file:
+            scenarios = json.load(file)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            directory = Path(tmp_dir)
+            source = directory / "scenario.json"
+            dump_json_array(scenarios, source)
+            makenai(source, directory, workers=1)
+            files = set(glob.glob(str(directory / "*.scenario")))
+
+            with unittest.mock.patch(
+                "aids.commands._nai_scenario_file",
+                side_effect=aids.commands._nai_scenario_file,
+            ) as convert:
+                makenai(source, directory, workers=1)
+                convert.assert_not_called()
+                self.assertEqual(set(glob.glob(str(directory / "*.scenario"))), files)
+
+                # one changed, one gone
+                scenarios[0] = {**scenarios[0], "prompt": "A new prompt."}
+                dump_json_array(scenarios[:-1], source)
+                makenai(source, directory, workers=1)
+
+            self.assertEqual(convert.call_count, 1)
+            changed = glob.glob(str(directory / f"{scenarios[0]['title']}_*.scenario"))
+            self.assertEqual(len(changed), 1)
+            with open(changed[0]) as file:
+                self.assertEqual(json.load(file)["prompt"], "A new prompt.")
+            self.assertEqual(
+                len(glob.glob(str(directory / "*.scenario"))), len(files) - 1
+            )
+
+    def test_makenai_in_parallel(self):
+        def written():
+            files = glob.glob(str(TEST_DIR / "*_*-*.scenario"))
+            contents = {}
+            for name in files:
+                with open(name) as file:
+                    contents[Path(name).name.rsplit("_", 1)[0]] = file.read()
+                os.remove(name)
+            return contents
+
+        makenai(self.json_infile, TEST_DIR, workers=1)
+        serial = written()
+        makenai(self.json_infile, TEST_DIR, workers=2)
+
+        self.assertGreater(len(serial), 60)
+        self.assertEqual(written(), serial)
+
 
 # Schizo test cases to mock API calls so everything can be tested without
 # relying on their server
@@ -221,6 +392,7 @@ class TestLogin(unittest.TestCase):
 
         self.assertEqual(self.client.session.headers["x-access-token"], "dummyToken")
 
+
 class dummy_obj:
     def __init__(self, id_maj=1, id_min=1):
         self.id = f"{id_maj}.{id_min}"
@@ -251,7 +423,7 @@ class dummy_nested_scen(dummy_obj):
             return self.isOption
         elif key == "options":
             return self.options
-        super().__getitem__(key)
+        return super().__getitem__(key)
 
     def __setitem__(self, key, value):
         if key == "isOption":
@@ -276,6 +448,8 @@ class ClientGetStories(unittest.TestCase):
         self.client.prompts = unittest.mock.Mock()
         # so it passes len()
         self.client.prompts.__len__ = lambda cls: 0
+        # the dummy objects can not be saved
+        self.client.crawl_dir = None
 
         obj_gen = (
             (dummy_obj(major, minor) for minor in range(3)) for major in range(3)
@@ -300,6 +474,43 @@ class ClientGetStories(unittest.TestCase):
         self.client.get_stories()
         self.assertEqual(self.client.adventures.add.call_count, 9)
 
+    def test_concurrent_get_stories_keeps_order(self):
+        self.client.workers = 4
+        self.client._get_story_content = lambda story_id: story_id
+
+        self.client.get_stories()
+
+        added = [call.args[0] for call in self.client.adventures._add.call_args_list]
+        self.assertEqual(
+            added, [f"{major}.{minor}" for major in range(3) for minor in range(3)]
+        )
+
+    def test_concurrent_get_stories_stops_under_min_act(self):
+        self.client.workers = 4
+        self.client.adventures._add.side_effect = [None, ValidationError]
+
+        self.client.get_stories()
+
+        self.assertEqual(self.client.adventures._add.call_count, 2)
+
+    def test_pages_follow_offset_until_empty_page(self):
+        offsets = []
+
+        def query_objects(query):
+            offsets.append(query["variables"]["input"]["offset"])
+            return self.generate_or_empty(pages)
+
+        pages = iter(([1, 2, 3], [4, 5, 6], [7]))
+        self.client._query_objects = query_objects
+
+        self.assertEqual(
+            list(self.client._pages(self.client.stories_query)),
+            [[1, 2, 3], [4, 5, 6], [7]],
+        )
+        self.assertEqual(offsets, [0, 3, 6, 7])
+        # the shared query scheme is left alone
+        self.assertNotIn("offset", self.client.stories_query["variables"]["input"])
+
     def test_basic_get_scenarios(self):
         self.client.add_all_scenarios = unittest.mock.Mock()
         self.client.get_scenarios()
@@ -321,15 +532,1104 @@ class ClientGetStories(unittest.TestCase):
 
         #        self.client._get_scenario_content = lambda id: self.generate_or_empty(obj)
         self.client._get_scenario_content = unittest.mock.Mock(
-            side_effect=lambda query: self.generate_or_empty(obj)
+            side_effect=lambda query, updated_at: self.generate_or_empty(obj)
         )
 
         self.client.add_all_scenarios("doesn't matter")
 
-        self.assertEqual(self.client.offset, 1)  # options are not added to offset
-
         self.assertEqual(self.client._get_scenario_content.call_count, 4)
 
+    def test_add_all_scenarios_fetches_shared_options_once(self):
+        tree = {
+            "root": {
+                "title": "root",
+                "options": [{"publicId": "a"}, {"publicId": "b"}],
+            },
+            "a": {"title": "a", "options": [{"publicId": "b"}, {"publicId": "root"}]},
+            "b": {"title": "b", "options": []},
+        }
+        self.client.workers = 2
+        self.client._get_scenario_content = unittest.mock.Mock(
+            side_effect=lambda pubid, updated_at: dict(tree[pubid])
+        )
+
+        self.client.add_all_scenarios("root")
+
+        self.assertEqual(self.client._get_scenario_content.call_count, 3)
+        # children first, parents last
+        added = [
+            call.args[0]["title"] for call in self.client.prompts.add.call_args_list
+        ]
+        self.assertEqual(added, ["b", "a", "root"])
+
+    def test_options_are_revalidated_by_their_parent(self):
+        tree = {
+            "root": {
+                "title": "root",
+                "updatedAt": "2",
+                "options": [{"publicId": "a"}],
+            },
+            "a": {"title": "a", "updatedAt": None, "options": [{"publicId": "b"}]},
+            "b": {"title": "b", "options": []},
+        }
+        self.client.updated_at = {"root": "1"}
+        self.client._get_scenario_content = unittest.mock.Mock(
+            side_effect=lambda pubid, updated_at: dict(tree[pubid])
+        )
+
+        self.client.add_all_scenarios("root")
+
+        self.assertEqual(
+            [call.args for call in self.client._get_scenario_content.call_args_list],
+            [("root", None), ("a", "2"), ("b", None)],
+        )
+        # the options expire like anything revalidated by another object
+        self.assertEqual(self.client._revalidation("root"), ("1", False))
+        self.assertEqual(self.client._revalidation("a", "2"), ("2", True))
+        self.assertEqual(self.client._revalidation("b"), (None, False))
+
+    def test_add_all_scenarios_resumes_crawl(self):
+        tree = {
+            "root": {"title": "root", "options": [{"publicId": "a"}]},
+            "a": {"title": "a", "options": [{"publicId": "b"}]},
+            "b": {"title": "b", "options": []},
+        }
+
+        def interrupt(pubid, updated_at):
+            if pubid == "b":
+                raise KeyboardInterrupt
+            return dict(tree[pubid])
+
+        with tempfile.TemporaryDirectory() as crawl_dir:
+            self.client.crawl_dir = Path(crawl_dir)
+            self.client._get_scenario_content = unittest.mock.Mock(
+                side_effect=interrupt
+            )
+            self.assertRaises(KeyboardInterrupt, self.client.add_all_scenarios, "root")
+            self.client.prompts.add.assert_not_called()
+
+            self.client._get_scenario_content = unittest.mock.Mock(
+                side_effect=lambda pubid, updated_at: dict(tree[pubid])
+            )
+            self.client.add_all_scenarios("root")
+
+            self.client._get_scenario_content.assert_called_once_with("b", None)
+            self.assertEqual(self.client.prompts.add.call_count, 3)
+            self.assertFalse(os.listdir(crawl_dir))
+
+
+class dummy_response:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class ClientIncrementalSync(unittest.TestCase):
+    def setUp(self):
+        self.client = AIDScrapper()
+        self.client.logger = unittest.mock.Mock()
+
+        with open(TEST_DIR / "test_stories.json") as file:
+            self.old, self.changed = [
+                story for story in json.load(file) if len(story["actions"]) > 10
+            ][:2]
+        self.client.adventures = Story()
+        self.client.adventures.add(self.old)
+        self.client.adventures.add(self.changed)
+        self.client.archived = self.client.adventures.index()
+
+        self.updated = dict(
+            self.changed,
+            actions=self.changed["actions"] + self.changed["actions"][:1],
+            updatedAt="9999-01-01T00:00:00.000Z",
+        )
+        listing = [
+            {key: story[key] for key in ("publicId", "title", "updatedAt")}
+            for story in (self.old, self.updated)
+        ]
+        pages = iter((listing,))
+        self.client._query_objects = lambda query: next(pages, [])
+        self.client._get_story_content = unittest.mock.Mock(return_value=self.updated)
+
+    def test_only_changed_stories_are_downloaded(self):
+        self.client.get_stories()
+
+        self.client._get_story_content.assert_called_once_with(self.changed["publicId"])
+        keys = set(self.client.adventures.keys())
+        self.assertIn((self.old["title"], len(self.old["actions"])), keys)
+        self.assertIn((self.updated["title"], len(self.updated["actions"])), keys)
+        self.assertNotIn((self.changed["title"], len(self.changed["actions"])), keys)
+        self.assertEqual(len(keys), 2)
+
+
+class ClientBatchQueries(unittest.TestCase):
+    def setUp(self):
+        self.client = AIDScrapper()
+        self.client.logger = unittest.mock.Mock()
+
+        self.scenario = {"data": {"scenario": {"title": "dummy"}}}
+        self.wi = {"data": {"worldInfoType": [{"keys": "a", "entry": "b"}]}}
+
+    def test_scenario_and_wi_in_one_request(self):
+        self.client.session.post = unittest.mock.Mock(
+            return_value=dummy_response([self.scenario, self.wi])
+        )
+
+        scenario = self.client._get_scenario_content("dummyId")
+
+        self.assertEqual(self.client.session.post.call_count, 1)
+        queries = self.client.session.post.call_args.kwargs["json"]
+        self.assertEqual(queries[0]["variables"], {"publicId": "dummyId"})
+        self.assertEqual(queries[1]["variables"]["contentPublicId"], "dummyId")
+        self.assertEqual(scenario["worldInfo"], [{"keys": "a", "entry": "b"}])
+
+    def test_fallback_when_batching_is_rejected(self):
+        self.client.session.post = unittest.mock.Mock(
+            side_effect=[
+                dummy_response({"errors": "batching is not supported"}),
+                dummy_response(self.wi),
+                dummy_response(self.scenario),
+            ]
+        )
+
+        scenario = self.client._get_scenario_content("dummyId")
+
+        self.assertFalse(self.client.batch_queries)
+        self.assertEqual(self.client.session.post.call_count, 3)
+        self.assertEqual(scenario["worldInfo"], [{"keys": "a", "entry": "b"}])
+
+    def test_wi_is_revalidated_by_updated_at(self):
+        self.client.batch_queries = False
+        self.client.updated_at = {"dummyId": "2021-01-01"}
+        self.client.session.post = unittest.mock.Mock(
+            side_effect=[dummy_response(self.wi), dummy_response(self.scenario)]
+        )
+
+        self.client._get_scenario_content("dummyId")
+
+        for call in self.client.session.post.call_args_list:
+            self.assertEqual(call.kwargs["updated_at"], "2021-01-01")
+
+    def http_error(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return requests.exceptions.HTTPError(response=response)
+
+    def test_bad_request_disables_batching(self):
+        self.client.session.post = unittest.mock.Mock(
+            side_effect=[
+                self.http_error(400),
+                dummy_response(self.wi),
+                dummy_response(self.scenario),
+            ]
+        )
+
+        self.client._get_scenario_content("dummyId")
+
+        self.assertFalse(self.client.batch_queries)
+
+    def test_other_failures_keep_batching(self):
+        self.client.session.post = unittest.mock.Mock(
+            side_effect=[
+                self.http_error(503),
+                dummy_response(self.wi),
+                dummy_response(self.scenario),
+                dummy_response([{"data": {}}, {"data": {}}]),
+                dummy_response(self.wi),
+                dummy_response(self.scenario),
+            ]
+        )
+
+        for _ in range(2):
+            scenario = self.client._get_scenario_content("dummyId")
+            self.assertTrue(self.client.batch_queries)
+            self.assertEqual(scenario["worldInfo"], [{"keys": "a", "entry": "b"}])
+        self.assertEqual(self.client.session.post.call_count, 6)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(
+            max_attempts=4, backoff=1, max_backoff=3, budget=60, jitter=False
+        )
+
+    def response(self, status_code, headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers or {})
+        response._content = b"{}"
+        return response
+
+    def test_exponential_backoff(self):
+        started = time.monotonic()
+        delays = [self.policy.delay(attempt, started) for attempt in range(1, 5)]
+
+        self.assertEqual(delays, [1, 2, 3, None])
+
+    def test_budget(self):
+        self.assertIsNone(self.policy.delay(1, time.monotonic() - 60))
+
+    def test_retry_after(self):
+        response = self.response(429, {"Retry-After": "10"})
+
+        self.assertEqual(self.policy.delay(1, time.monotonic(), response), 10)
+
+    def test_check_errors_retries_busy_server(self):
+        session = Session(self.policy, RateLimiter(default=1000))
+        responses = iter((self.response(503), self.response(429), self.response(200)))
+        with unittest.mock.patch(
+            "requests.Session.request", lambda *args, **kwargs: next(responses)
+        ), unittest.mock.patch("aids.app.client.time.sleep") as sleep:
+            response = session.get("https://example.com")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.policy.retries, 2)
+
+    def test_check_errors_gives_up(self):
+        session = Session(self.policy, RateLimiter(default=1000))
+        with unittest.mock.patch(
+            "requests.Session.request",
+            unittest.mock.Mock(side_effect=requests.exceptions.ConnectionError),
+        ), unittest.mock.patch("aids.app.client.time.sleep"):
+            self.assertRaises(
+                requests.exceptions.ConnectionError, session.get, "https://example.com"
+            )
+
+        self.assertEqual(self.policy.retries, 3)
+        self.assertEqual(self.policy.failures, 1)
+
+    def test_requests_time_out(self):
+        session = Session(self.policy, RateLimiter(default=1000))
+        session.timeout = 5
+        send = unittest.mock.Mock(return_value=self.response(200))
+        with unittest.mock.patch("requests.Session.request", send):
+            session.get("https://example.com")
+
+        self.assertEqual(send.call_args.kwargs["timeout"], 5)
+
+    def test_mutations_are_not_sent_twice(self):
+        session = Session(self.policy, RateLimiter(default=1000))
+        responses = iter((self.response(429), self.response(504)))
+        send = unittest.mock.Mock(side_effect=lambda *args, **kwargs: next(responses))
+        with unittest.mock.patch("requests.Session.request", send), unittest.mock.patch(
+            "aids.app.client.time.sleep"
+        ):
+            self.assertRaises(
+                requests.exceptions.HTTPError,
+                session.post,
+                "https://example.com",
+                idempotent=False,
+            )
+            # refused, then maybe processed: only the 429 is retried
+            self.assertEqual(send.call_count, 2)
+
+            send.reset_mock(side_effect=True)
+            send.side_effect = requests.exceptions.ConnectionError
+            self.assertRaises(
+                requests.exceptions.ConnectionError,
+                session.post,
+                "https://example.com",
+                idempotent=False,
+            )
+            self.assertEqual(send.call_count, 1)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.bucket = TokenBucket(2, clock=lambda: self.now)
+
+    def test_burst_then_wait(self):
+        self.assertEqual([self.bucket.reserve() for _ in range(3)], [0, 0, 0.5])
+
+        self.now = 1.0
+        # the waiting caller already took the token refilled meanwhile
+        self.assertEqual(self.bucket.reserve(), 0)
+
+    def test_adapts_to_throttling(self):
+        self.bucket.slow_down()
+        self.assertEqual(self.bucket.rate, 1)
+
+        for _ in range(100):
+            self.bucket.speed_up()
+        self.assertEqual(self.bucket.rate, 2)
+
+    def test_no_limit_until_throttled(self):
+        bucket = TokenBucket(None, clock=lambda: self.now, throttled_rate=2)
+        self.assertEqual([bucket.reserve() for _ in range(100)], [0] * 100)
+
+        bucket.slow_down()
+        self.assertEqual(bucket.rate, 1)
+        self.assertEqual([bucket.reserve() for _ in range(2)], [0, 1])
+
+        for _ in range(100):
+            bucket.speed_up()
+        self.assertIsNone(bucket.rate)
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_buckets_per_host(self):
+        limiter = RateLimiter({"slow.com": 1}, default=10)
+
+        self.assertIs(
+            limiter.bucket("https://slow.com/a"), limiter.bucket("http://slow.com/b")
+        )
+        self.assertEqual(limiter.bucket("https://slow.com").rate, 1)
+        self.assertEqual(limiter.bucket("https://fast.com").rate, 10)
+
+
+class TestClubClient(unittest.TestCase):
+    def setUp(self):
+        with self.assertWarns(UserWarning):
+            self.client = ClubClient()
+        self.client.session.rate_limiter = unittest.mock.Mock()
+
+    def test_publish_is_rate_limited(self):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = "https://prompts.aidg.club/1234"
+        scenario = {
+            "title": "dummy",
+            "description": "",
+            "prompts": "",
+            "memory": "",
+            "authorsNote": "",
+            "tags": ["nsfw"],
+        }
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.object(
+            requests.Session, "request", return_value=response
+        ):
+            os.chdir(tmp_dir)
+            try:
+                with open("scenario.json", "w") as file:
+                    json.dump({"scenarios": [scenario]}, file)
+                self.client.publish_scenario("dummy")
+            finally:
+                os.chdir(cwd)
+
+        self.client.session.rate_limiter.wait.assert_called_once_with(
+            "https://prompts.aidg.club/?confirm=false#"
+        )
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.transport = Transport(pool_maxsize=2)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_sessions_share_pools_by_host(self):
+        first = Session(transport=self.transport)
+        second = Session(transport=self.transport)
+
+        self.assertIs(
+            first.get_adapter("https://api.aidungeon.io/graphql"),
+            second.get_adapter("https://API.aidungeon.io/other"),
+        )
+        self.assertIsNot(
+            first.get_adapter("https://api.aidungeon.io/graphql"),
+            first.get_adapter("https://writeholo.com/api/"),
+        )
+
+    def test_pool_grows_with_workers(self):
+        url = "https://api.aidungeon.io/graphql"
+
+        self.transport.reserve(url, 8)
+        self.assertEqual(self.transport.adapter(url).pool_maxsize, 8)
+
+        # never shrinks
+        self.transport.reserve(url, 4)
+        self.assertEqual(self.transport.adapter(url).pool_maxsize, 8)
+
+    @unittest.skipIf(httpx is None, "httpx is not installed")
+    def test_http2_refuses_what_it_can_not_honour(self):
+        with unittest.mock.patch.object(HTTP2Adapter, "_new_client"):
+            adapter = HTTP2Adapter()
+        request = requests.Request("GET", "https://api.aidungeon.io/").prepare()
+
+        for options in (
+            {"proxies": {"https": "socks5h://127.0.0.1:9050"}},
+            {"verify": False},
+            {"verify": "/etc/ssl/ca.pem"},
+            {"cert": "client.pem"},
+        ):
+            with self.subTest(options=options):
+                self.assertRaises(NotImplementedError, adapter.send, request, **options)
+        adapter.client.request.assert_not_called()
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.tmp_dir.name, ttl=60, max_size=1000)
+        self.key = self.cache.key(
+            "https://api.aidungeon.io/graphql",
+            {"query": "query", "variables": {"publicId": "1"}},
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_key_depends_on_variables(self):
+        other = self.cache.key(
+            "https://api.aidungeon.io/graphql",
+            {"query": "query", "variables": {"publicId": "2"}},
+        )
+
+        self.assertNotEqual(self.key, other)
+
+    def test_ttl(self):
+        self.cache.set(self.key, b"{}")
+        self.assertEqual(self.cache.get(self.key), b"{}")
+
+        self.cache.ttl = 0
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_revalidate_by_updated_at(self):
+        self.cache.set(self.key, b"{}", updated_at="2021-05-14")
+        self.cache.ttl = 0
+
+        self.assertEqual(self.cache.get(self.key, "2021-05-14"), b"{}")
+        self.assertIsNone(self.cache.get(self.key, "2021-05-15"))
+
+    def test_revalidated_entries_that_expire(self):
+        self.cache.set(self.key, b"{}", updated_at="2021-05-14")
+
+        self.assertEqual(self.cache.get(self.key, "2021-05-14", expires=True), b"{}")
+        self.assertIsNone(self.cache.get(self.key, "2021-05-15", expires=True))
+        self.cache.ttl = 0
+        self.assertIsNone(self.cache.get(self.key, "2021-05-14", expires=True))
+
+    def test_lru_eviction(self):
+        for number in range(10):
+            self.cache.set(str(number), b"x" * 100)
+            os.utime(self.cache.directory / f"{number}.json", (number, number))
+
+        self.assertLessEqual(self.cache.size, 1000)
+        self.assertIsNone(self.cache.get("0"))
+        self.assertIsNotNone(self.cache.get("9"))
+
+    def test_session_reuses_responses(self):
+        session = Session(cache=self.cache)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"data": {"adventure": {}}}'
+        send = unittest.mock.Mock(return_value=response)
+        payload = {"query": "query", "variables": {"publicId": "1"}}
+
+        with unittest.mock.patch("requests.Session.request", send):
+            for _ in range(2):
+                res = session.post("https://example.com", json=payload, cache=True)
+                self.assertEqual(res.json(), {"data": {"adventure": {}}})
+
+        self.assertEqual(send.call_count, 1)
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "stories.json"
+        with open(TEST_DIR / "test_stories.json") as file:
+            self.stories = json.load(file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_same_output_as_json_dump(self):
+        for values in (self.stories, []):
+            dump_json_array(iter(values), self.path)
+
+            with open(self.path) as file:
+                self.assertEqual(file.read(), json.dumps(tuple(values)))
+
+    def test_failed_dump_keeps_previous_file(self):
+        dump_json_array(self.stories, self.path)
+
+        self.assertRaises(TypeError, dump_json_array, [{}, object()], self.path)
+        with open(self.path) as file:
+            self.assertEqual(json.load(file), self.stories)
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["stories.json"])
+
+    def test_backup_survives_next_dump(self):
+        backup = Path(self.tmp_dir.name) / "backup.json"
+        dump_json_array(self.stories, self.path)
+        copy_file(self.path, backup)
+
+        dump_json_array([], self.path)
+
+        with open(backup) as file:
+            self.assertEqual(json.load(file), self.stories)
+
+    def test_iter_json_array(self):
+        dump_json_array(self.stories + [1.5, "a", [], None], self.path)
+
+        for chunk_size in (1, 7, 2**16):
+            with open(self.path) as file:
+                self.assertEqual(
+                    list(iter_json_array(file, chunk_size)),
+                    self.stories + [1.5, "a", [], None],
+                )
+
+    def test_iter_json_array_errors(self):
+        for raw, error in (
+            ('{"a": 1}', TypeError),
+            ('[{"a": 1}, {"a": ', json.JSONDecodeError),
+            ('[{"a": 1} {"a": 2}]', json.JSONDecodeError),
+        ):
+            self.path.write_text(raw)
+            with open(self.path) as file:
+                items = iter_json_array(file, 4)
+                with self.assertRaises(error):
+                    for item in items:
+                        self.assertEqual(item, {"a": 1})
+
+    def test_load_skips_malformed_objects(self):
+        stories = Story()
+        stories.default_json_file = self.path
+        stories.logger_err = unittest.mock.Mock()
+        dump_json_array([self.stories[0], [1, 2], "story"], self.path)
+
+        stories.load()
+
+        self.assertEqual(len(stories), 1)
+        self.assertEqual(stories.logger_err.error.call_count, 2)
+
+
+class TestBackupStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmp_dir.name)
+        self.storage = JSONStorage(self.directory / "story.json")
+        self.backups = BackupStore(self.directory / "backups", keep=2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def contents(self):
+        return sorted(os.listdir(self.directory / "backups" / "objects"))
+
+    def test_identical_archives_are_stored_once(self):
+        dump_json_array([{"a": 1}], self.storage.path)
+        first = self.backups.add(self.storage, "story.json")
+        dump_json_array([{"a": 1}], self.storage.path)
+        second = self.backups.add(self.storage, "story.json")
+
+        self.assertEqual(first["hash"], second["hash"])
+        self.assertEqual(self.backups.backups(), [second])
+        self.assertEqual(self.contents(), [first["hash"] + ".json"])
+
+    def test_retention(self):
+        for number in range(4):
+            dump_json_array([{"a": number}], self.storage.path)
+            self.backups.add(self.storage, "story.json")
+        self.backups.add(self.storage, "scenario.json")
+
+        self.assertEqual(len(self.backups.backups("story.json")), 2)
+        self.assertEqual(len(self.contents()), 2)
+        restored = self.directory / "restored.json"
+        self.backups.restore("story.json", restored, 1)
+        with open(restored) as file:
+            self.assertEqual(json.load(file), [{"a": 2}])
+
+        # the newest one stays, however old
+        self.backups.max_age = 0
+        dump_json_array([{"a": 4}], self.storage.path)
+        self.backups.add(self.storage, "story.json")
+        self.assertEqual(len(self.backups.backups("story.json")), 1)
+
+    def test_untouched_archive_is_not_read_again(self):
+        dump_json_array([{"a": 1}], self.storage.path)
+        first = self.backups.add(self.storage, "story.json")
+        with unittest.mock.patch.object(self.storage, "backup") as backup:
+            second = self.backups.add(self.storage, "story.json")
+
+        backup.assert_not_called()
+        self.assertEqual(second["hash"], first["hash"])
+        self.assertEqual(self.backups.backups(), [second])
+
+    def test_legacy_backups_join_the_store(self):
+        legacy = self.directory / "backups"
+        legacy.mkdir()
+        for number in range(3):
+            path = legacy / f"story_{uuid.uuid4()}.json"
+            dump_json_array([{"a": number}], path)
+            os.utime(path, (number, number))
+
+        dump_json_array([{"a": 3}], self.storage.path)
+        self.backups.add(self.storage, "/home/me/story.json")
+
+        self.assertEqual(sorted(os.listdir(legacy)), ["index.json", "objects"])
+        # the newest two only
+        self.assertEqual(
+            [backup["time"] for backup in self.backups.backups("story.json")], [2, 1]
+        )
+        restored = self.directory / "restored.json"
+        self.backups.restore("story.json", restored)
+        with open(restored) as file:
+            self.assertEqual(json.load(file), [{"a": 2}])
+
+    def test_compression(self):
+        self.backups.compress = True
+        dump_json_array([{"a": "b" * 1000}], self.storage.path)
+        backup = self.backups.add(self.storage, "story.json")
+
+        self.assertEqual(self.contents(), [backup["hash"] + ".json.gz"])
+        restored = self.directory / "restored.json"
+        self.backups.restore("story.json", restored)
+        self.assertEqual(restored.read_bytes(), self.storage.path.read_bytes())
+
+
+class TestRecords(unittest.TestCase):
+    def setUp(self):
+        with open(TEST_DIR / "test_stories.json") as file:
+            self.stor_in = json.load(file)
+        with open(TEST_DIR / "test_scen.json") as file:
+            self.scen_in = json.load(file)
+
+    def test_lossless(self):
+        for record_class, objects in (
+            (records.Story, self.stor_in),
+            (records.Scenario, self.scen_in),
+        ):
+            compact = [record_class.from_dict(data) for data in objects]
+
+            self.assertEqual([record.to_dict() for record in compact], objects)
+            self.assertEqual(
+                json.dumps(compact, default=records.encode), json.dumps(objects)
+            )
+
+    def test_read_like_a_dict(self):
+        story = records.Story.from_dict(self.stor_in[0])
+
+        self.assertEqual(story["title"], self.stor_in[0]["title"])
+        self.assertEqual(story["actions"][0]["id"], self.stor_in[0]["actions"][0]["id"])
+        self.assertEqual(dict(story["actions"][0]), self.stor_in[0]["actions"][0])
+        self.assertIsNone(story.get("sneed"))
+        self.assertRaises(KeyError, story.__getitem__, "sneed")
+
+    def test_packed_fields(self):
+        for action in (
+            {"id": "0123", "text": "", "type": "do", "createdAt": "yesterday"},
+            {"id": 123, "text": "", "type": "do", "createdAt": "2021-05-14T03:56:09Z"},
+            {"id": "123", "createdAt": "2021-05-14T03:56:09.539Z", "type": "say"},
+        ):
+            record = records.Action.from_dict(action)
+            self.assertEqual(record.to_dict(), action)
+            self.assertEqual(list(record.to_dict()), list(action))
+
+        types = {
+            records.Action.from_dict({"type": "".join(["con", "tinue"])}).type
+            for _ in range(2)
+        }
+        self.assertIs(types.pop(), records.ACTION_TYPES[1])
+
+    def test_container_saves_the_same(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        files = []
+        for compact in (False, True):
+            stories = Story()
+            stories.compact = compact
+            stories.default_json_file = Path(tmp_dir.name) / f"{compact}.json"
+            for story in self.stor_in:
+                stories.add(story)
+            stories.storage.save(stories)
+            files.append(stories.default_json_file.read_text())
+
+        self.assertEqual(files[0], files[1])
+
+    def test_records_can_be_stored_back(self):
+        with open(TEST_DIR / "test_scen.json") as file:
+            scen_in = json.load(file)
+        scenarios = Scenario()
+        scenarios.compact = True
+        for scenario in scen_in:
+            scenarios.add(scenario)
+        key, scenario = next(
+            (key, value) for key, value in scenarios.items() if value["options"]
+        )
+
+        scenarios[key] = scenario
+
+        self.assertIsInstance(scenarios[key], records.Scenario)
+        self.assertEqual(scenarios[key], scenario)
+
+    @staticmethod
+    def traced_size(build):
+        tracemalloc.start()
+        try:
+            built = build()
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del built
+        return size
+
+    def test_memory(self):
+        # what the records save is the dicts and the packed fields, not the
+        # texts: about half the memory for short actions, a third less for
+        # whole stories. The columnar store is the one that goes further.
+        actions = json.dumps(
+            [
+                {
+                    "id": str(4895748458 + number),
+                    "text": "You go north.",
+                    "type": "do",
+                    "createdAt": "2021-05-14T03:56:09.539Z",
+                }
+                for number in range(10000)
+            ]
+        )
+        with open(TEST_DIR / "test_stories.json") as file:
+            stories = file.read()
+
+        for raw, record_class, ratio in (
+            (actions, records.Action, 1.9),
+            (stories, records.Story, 1.5),
+        ):
+            with self.subTest(record_class=record_class.__name__):
+                plain_size = self.traced_size(lambda: json.loads(raw))
+                compact_size = self.traced_size(
+                    lambda: [record_class.from_dict(obj) for obj in json.loads(raw)]
+                )
+                self.assertLess(compact_size * ratio, plain_size)
+
+
+class TestActionColumns(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "story.columns"
+        with open(TEST_DIR / "test_stories.json") as file:
+            self.stor_in = json.load(file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def as_lists(stories):
+        return [{**story, "actions": list(story["actions"])} for story in stories]
+
+    def test_save_and_load(self):
+        self.stor_in[0]["actions"][0]["extra"] = True
+        self.stor_in[0]["actions"][1]["id"] = "not a number"
+        ActionColumns.from_stories(self.stor_in).save(self.path)
+
+        columns = ActionColumns.load(self.path)
+
+        self.assertEqual(len(columns.extras), 2)
+        self.assertEqual(self.as_lists(columns.stories()), self.stor_in)
+
+    def test_zero_copy_views(self):
+        ActionColumns.from_stories(self.stor_in).save(self.path)
+        columns = ActionColumns.load(self.path)
+        actions = columns.story(3)["actions"]
+
+        texts = actions[1:3].texts
+        self.assertIs(texts.obj, columns.texts.obj)
+        self.assertEqual(
+            bytes(texts).decode(),
+            "".join(action["text"] for action in self.stor_in[3]["actions"][1:3]),
+        )
+        self.assertEqual(
+            sum(1 for code in columns.types if code == columns.type_code("say")),
+            sum(
+                action["type"] == "say"
+                for story in self.stor_in
+                for action in story["actions"]
+            ),
+        )
+
+    def test_story_container_and_html(self):
+        stories = Story()
+        stories.default_json_file = self.path
+        for story in self.stor_in:
+            stories.add(story)
+        stories.dump()
+        reloaded = Story()
+        reloaded.default_json_file = self.path
+        reloaded.load()
+
+        self.assertEqual(
+            self.as_lists(reloaded.values()), self.as_lists(stories.values())
+        )
+        self.assertEqual(
+            self.as_lists(stories.to_columns().stories()),
+            self.as_lists(stories.values()),
+        )
+
+        html = to_html.toHtml()
+        html.out_path = Path(self.tmp_dir.name)
+        html.story_to_html(self.path)
+        with open(
+            Path(self.tmp_dir.name) / "stories/Eiyuu Senki: The World Conquest.html"
+        ) as file:
+            body = file.read()
+        story = next(
+            story
+            for story in self.stor_in
+            if story["title"] == "Eiyuu Senki: The World Conquest"
+        )
+        self.assertIn(story["actions"][-1]["createdAt"], body)
+
+    def test_compact_story_container(self):
+        stories = Story()
+        stories.compact = True
+        stories.default_json_file = self.path
+        for story in self.stor_in:
+            stories.add(story)
+        stories.dump()
+        reloaded = Story()
+        reloaded.default_json_file = self.path
+        reloaded.load()
+
+        self.assertEqual(
+            self.as_lists(reloaded.values()),
+            self.as_lists(story.to_dict() for story in stories.values()),
+        )
+
+
+class TestJSONLinesStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "story.jsonl"
+        with open(TEST_DIR / "test_stories.json") as file:
+            self.stories = Story()
+            for story in json.load(file):
+                self.stories.add(story)
+        self.stories.default_json_file = self.path
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def reloaded(self):
+        stories = Story()
+        stories.default_json_file = self.path
+        stories.load()
+        return stories
+
+    def assertSameStories(self, first, second):
+        # the keys of titles with slashes change when they are cleaned
+        self.assertEqual(
+            sorted(map(json.dumps, first.values())),
+            sorted(map(json.dumps, second.values())),
+        )
+
+    def test_save_and_load(self):
+        self.stories.dump()
+
+        self.assertSameStories(self.reloaded(), self.stories)
+        self.assertFalse(self.stories.dirty)
+
+    def test_checkpoint_appends_changes(self):
+        self.stories.storage.save(self.stories)
+        size = self.path.stat().st_size
+        key, story = next(iter(self.stories.items()))
+
+        self.stories.pop(key)
+        self.stories.checkpoint()
+        self.assertNotIn(key, self.reloaded())
+
+        self.stories[key] = story
+        self.stories.checkpoint()
+        self.assertSameStories(self.reloaded(), self.stories)
+        # nothing was rewritten
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(size), self.path.read_bytes()[:size])
+        self.assertEqual(self.stories.storage.get(key), story)
+
+    def test_compaction(self):
+        storage = JSONLinesStorage(self.path, compact_ratio=0.5)
+        for _ in range(3):
+            self.stories.dirty.update(dict.fromkeys(self.stories))
+            storage.save(self.stories)
+
+        self.assertEqual(storage.lines, len(self.stories))
+        self.assertSameStories(self.reloaded(), self.stories)
+
+    def test_index_and_interrupted_write(self):
+        self.stories.storage.save(self.stories)
+        key = next(iter(self.stories))
+        with open(self.path, "ab") as file:
+            file.write(b'{"key": ["sneed", 20], "deleted": true}\n{"key": ')
+
+        storage = JSONLinesStorage(self.path)
+        self.assertEqual(storage.get(key), self.stories[key])
+        self.assertEqual(storage.lines, len(self.stories) + 1)
+        self.assertTrue(self.path.read_bytes().endswith(b"true}\n"))
+
+
+class TestArchiveDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "story.sqlite3"
+        self.database = ArchiveDatabase(self.path, batch_size=7)
+        with open(TEST_DIR / "test_stories.json") as file:
+            self.stor_in = json.load(file)
+
+    def tearDown(self):
+        self.database.close()
+        self.tmp_dir.cleanup()
+
+    def test_import_and_find(self):
+        read = self.database.import_objects(Story(), self.stor_in)
+
+        self.assertEqual(read, len(self.stor_in))
+        self.assertEqual(len(self.database), len(self.stor_in))
+        long_ones = list(self.database.find(min_actions=100))
+        self.assertTrue(long_ones)
+        self.assertTrue(all(len(story["actions"]) >= 100 for story in long_ones))
+        title = self.stor_in[0]["title"]
+        self.assertEqual(
+            [story["title"] for story in self.database.find(title=title)],
+            [story["title"] for story in self.stor_in if story["title"] == title],
+        )
+
+    def test_mapping(self):
+        story = self.stor_in[0]
+        key = (story["title"], len(story["actions"]))
+
+        self.database[key] = story
+        self.assertIn(key, self.database)
+        self.assertEqual(self.database[key], story)
+        self.assertEqual(list(self.database), [key])
+
+        del self.database[key]
+        self.assertNotIn(key, self.database)
+        self.assertRaises(KeyError, self.database.__getitem__, key)
+
+    def test_storage_backend(self):
+        stories = Story()
+        stories.default_json_file = self.path
+        for story in self.stor_in:
+            stories.add(story)
+        stories.dump()
+        key = next(iter(stories))
+        stories.pop(key)
+        stories.dump()
+
+        reloaded = Story()
+        reloaded.default_json_file = self.path
+        reloaded.load()
+        self.assertEqual(list(reloaded.values()), list(stories.values()))
+        self.assertNotIn(key, self.database)
+
+
+class TestArchiveReader(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "story.json"
+        with open(TEST_DIR / "test_stories.json") as file:
+            self.stor_in = json.load(file)
+        # multibyte characters move the byte offsets away from the string ones
+        self.stor_in[0]["title"] = "Ça, c'est l'été 夏"
+        with open(self.path, "w") as file:
+            json.dump(self.stor_in, file, ensure_ascii=False, indent=1)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_spans(self):
+        data = self.path.read_bytes()
+        with open(self.path, "rb") as file:
+            for value, start, end in iter_json_array(file, chunk_size=100, spans=True):
+                self.assertEqual(json.loads(data[start:end]), value)
+
+    def test_random_access(self):
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(len(reader), len(self.stor_in))
+            self.assertEqual(list(reader), self.stor_in)
+            for story in self.stor_in:
+                self.assertEqual(reader[story["publicId"]], story)
+            story = self.stor_in[0]
+            key = (story["title"], len(story["actions"]))
+            self.assertIn(key, reader)
+            self.assertEqual(reader[key], story)
+            self.assertEqual(reader.by_title(story["title"]), [story])
+            self.assertIsNone(reader.get("sneed"))
+            self.assertRaises(KeyError, reader.__getitem__, ("sneed", 1))
+
+    def test_index_is_rebuilt(self):
+        ArchiveReader(self.path).close()
+        self.assertTrue(self.path.with_name("story.json.idx").exists())
+
+        dump_json_array(self.stor_in[1:], self.path)
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(list(reader), self.stor_in[1:])
+            self.assertNotIn(self.stor_in[0]["publicId"], reader)
+
+
+@unittest.skipUnless(httpx, "httpx is not installed")
+class AsyncClientGetObjects(unittest.TestCase):
+    def setUp(self):
+        self.client = AsyncAIDScrapper()
+        self.client.logger = unittest.mock.Mock()
+        self.client.workers = 4
+        self.client.crawl_dir = None
+
+        self.client.adventures = unittest.mock.Mock()
+        self.client.adventures.title = ""
+        self.client.adventures.__len__ = lambda cls: 0
+        self.client.prompts = unittest.mock.Mock()
+        self.client.prompts.title = ""
+        self.client.prompts.__len__ = lambda cls: 0
+
+        self.pages = {0: ["a", "b"], 2: ["c"], 3: []}
+        self.statuses = []
+        self.client.session.rate_limiter = RateLimiter(default=1000)
+        self.client.session.cache = None
+        self.client.session.client = httpx.AsyncClient(
+            transport=httpx.MockTransport(self.handler)
+        )
+
+    def handler(self, request):
+        if self.statuses:
+            return httpx.Response(self.statuses.pop())
+        body = json.loads(request.content)
+        if isinstance(body, list):
+            return httpx.Response(400)
+        variables = body["variables"]
+        if "input" in variables:
+            page = [
+                {"publicId": pubid, "title": pubid}
+                for pubid in self.pages[variables["input"]["offset"]]
+            ]
+            data = {"user": {"search": page}}
+        elif "contentPublicId" in variables:
+            data = {"worldInfoType": []}
+        elif "adventure(" in body["query"]:
+            data = {"adventure": {"title": variables["publicId"]}}
+        else:
+            data = {"scenario": {"title": variables["publicId"], "options": []}}
+        return httpx.Response(200, json={"data": data})
+
+    def test_get_stories(self):
+        asyncio.run(self.client.get_stories())
+
+        added = [
+            call.args[0]["title"] for call in self.client.adventures._add.call_args_list
+        ]
+        self.assertEqual(added, ["a", "b", "c"])
+
+    def test_get_scenarios_without_batching(self):
+        with unittest.mock.patch("aids.app.client.log_http_error"):
+            asyncio.run(self.client.get_scenarios())
+
+        self.assertFalse(self.client.batch_queries)
+        self.assertEqual(self.client.prompts.add.call_count, 3)
+
+    def test_retries_busy_server(self):
+        self.client.retry_policy = RetryPolicy(backoff=0, jitter=False)
+        self.statuses = [503, 429]
+
+        asyncio.run(self.client.get_stories())
+
+        self.assertEqual(self.client.retry_policy.retries, 2)
+        self.assertEqual(self.client.adventures._add.call_count, 3)
+
 
 class TestHtmlFiles(unittest.TestCase):
     def setUp(self):
@@ -344,6 +1644,7 @@ class TestHtmlFiles(unittest.TestCase):
         html_indexes = glob.glob(str(TEST_DIR / "**/*.html"), recursive=True)
         for file in html_indexes:
             os.remove(file)
+        os.remove(TEST_DIR / "html.manifest")
 
     def assert_if_exists(self, body, element):
         # \"formatting\" is not compatible with the regex
@@ -352,6 +1653,94 @@ class TestHtmlFiles(unittest.TestCase):
         if element:
             self.assertRegex(body, do_regex(element))
 
+    def test_incremental_build(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            directory = Path(tmp_dir)
+            stories = self.stor_in[:3]
+            dump_json_array(stories, directory / "story.json")
+            th = to_html.toHtml()
+            th.out_path = directory
+            th.story_to_html()
+            pages = {
+                path: path.stat().st_mtime_ns for path in directory.glob("**/*.html")
+            }
+
+            stories[0] = {**stories[0], "description": "Changed."}
+            dump_json_array(stories[:2], directory / "story.json")
+            th.story_to_html()
+            rewritten = {
+                path
+                for path in directory.glob("**/*.html")
+                if path.stat().st_mtime_ns != pages[path]
+            }
+
+            # the changed story and the index
+            self.assertEqual(len(rewritten), 2)
+            self.assertIn(directory / "story_index.html", rewritten)
+            self.assertEqual(len(list(directory.glob("stories/*.html"))), 2)
+
+    def test_parallel_rendering_is_identical(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            outputs = []
+            for workers in (1, 3):
+                directory = Path(tmp_dir) / str(workers)
+                directory.mkdir()
+                th = to_html.toHtml()
+                th.out_path = directory
+                th.incremental = False
+                th.workers = workers
+                th.story_to_html(TEST_DIR / "test_stories.json")
+                outputs.append(
+                    {
+                        path.relative_to(directory): path.read_bytes()
+                        for path in directory.glob("**/*.html")
+                    }
+                )
+
+        self.assertTrue(outputs[0])
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_one_worker_per_core_by_default(self):
+        th = to_html.toHtml()
+        th.workers = None
+        with unittest.mock.patch.object(
+            to_html, "imap_bounded", return_value=[]
+        ), unittest.mock.patch.object(
+            os, "cpu_count", return_value=5
+        ), unittest.mock.patch(
+            "aids.app.settings.CONVERT_WORKERS", 2
+        ), tempfile.TemporaryDirectory() as tmp_dir:
+            th.out_path = Path(tmp_dir)
+            th.story_to_html(TEST_DIR / "test_stories.json")
+
+            self.assertEqual(to_html.imap_bounded.call_args.args[2], 5)
+
+    def test_precompiled_templates(self):
+        self.assertIs(to_html.toHtml().env, to_html.toHtml().env)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            directory = Path(tmp_dir)
+            compiled = directory / "templates_compiled"
+            with unittest.mock.patch.multiple(
+                to_html,
+                COMPILED_TEMPLATES_DIR=compiled,
+                PRECOMPILED_TEMPLATES=True,
+                _environment=None,
+            ):
+                self.assertRaises(ImproperlyConfigured, to_html.environment)
+                to_html.compile_templates()
+                th = to_html.toHtml()
+                self.assertIsInstance(th.env.loader, to_html.ModuleLoader)
+                th.out_path = directory
+                th.story_to_html(TEST_DIR / "test_stories.json")
+
+            pages = list(directory.glob("**/*.html"))
+            self.assertTrue(pages)
+            for path in pages:
+                self.assertEqual(
+                    path.read_bytes(),
+                    (TEST_DIR / path.relative_to(directory)).read_bytes(),
+                )
+
     def test_scenario_properly_formatted_to_html(self):
         # We pick a scenario with quests, rem, WI, etc.. to
         # test everything with one file
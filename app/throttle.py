@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+from aids.app import settings
+
+
+class TokenBucket:
+    """
+    Token bucket that lets through `rate` requests per second with bursts of
+    up to `capacity` requests. The rate adapts: it is halved when the server
+    complains and slowly climbs back to the original one.
+
+    A bucket without a rate lets everything through until the server
+    complains. It is then limited as if its rate were `throttled_rate`, and
+    goes back to no limit once it climbed back to that rate.
+    """
+
+    # never go slower than this fraction of the configured rate
+    min_rate_factor = 1 / 32
+    # fraction of the configured rate regained after each successful request
+    recovery_factor = 1 / 20
+
+    def __init__(
+        self,
+        rate: Optional[float],
+        capacity: float = None,
+        clock: Callable[[], float] = time.monotonic,
+        throttled_rate: float = settings.THROTTLED_RATE_LIMIT,
+    ):
+        self.max_rate = self.rate = rate
+        # the rate the limits are relative to
+        self.base_rate = rate or throttled_rate
+        self.capacity = capacity or max(1.0, self.base_rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token. Returns the seconds the caller must wait before using it."""
+        with self._lock:
+            now = self.clock()
+            if self.rate is None:
+                self.updated = now
+                return 0.0
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # a negative amount of tokens is the queue of waiting callers
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def slow_down(self):
+        with self._lock:
+            if self.rate is None:
+                self.rate = self.base_rate
+                self.tokens = min(self.tokens, 1.0)
+            self.rate = max(self.base_rate * self.min_rate_factor, self.rate / 2)
+
+    def speed_up(self):
+        with self._lock:
+            if self.rate is None:
+                return
+            self.rate += self.base_rate * self.recovery_factor
+            if self.max_rate is None:
+                if self.rate >= self.base_rate:
+                    self.rate = None
+            else:
+                self.rate = min(self.max_rate, self.rate)
+
+
+class RateLimiter:
+    """
+    One token bucket per host. Meant to be shared by all the sessions (and
+    threads) of the process so they all respect the same limits.
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, float] = None,
+        default: Optional[float] = settings.DEFAULT_RATE_LIMIT,
+    ):
+        self.limits = settings.RATE_LIMITS if limits is None else limits
+        self.default = default
+        self.buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.limits.get(host, self.default))
+            return self.buckets[host]
+
+    def delay(self, url: str) -> float:
+        """Reserve a request to the url. Returns the seconds to wait before sending it."""
+        return self.bucket(url).reserve()
+
+    def wait(self, url: str):
+        """Block until a request to the url is allowed."""
+        delay = self.delay(url)
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self, url: str):
+        """The server asked us to slow down (429)."""
+        self.bucket(url).slow_down()
+
+    def succeeded(self, url: str):
+        self.bucket(url).speed_up()
+
+
+# shared by every session in the process
+rate_limiter = RateLimiter()
@@ -0,0 +1,179 @@
+import http.client
+import threading
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import select_proxy
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from aids.app import settings
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    The default requests adapter (HTTP/1.1 with keep-alive) with a pool
+    that can grow after being created.
+    """
+
+    def __init__(self, pool_maxsize: int = settings.POOL_MAXSIZE):
+        super().__init__(
+            pool_connections=settings.POOL_CONNECTIONS,
+            pool_maxsize=pool_maxsize,
+            pool_block=settings.POOL_BLOCK,
+        )
+
+    @property
+    def pool_maxsize(self) -> int:
+        return self._pool_maxsize
+
+    def resize(self, pool_maxsize: int):
+        # the idle connections of the old pool are dropped
+        self.poolmanager.clear()
+        self.init_poolmanager(self._pool_connections, pool_maxsize, self._pool_block)
+
+
+class _CookieSource:
+    """Just enough of an urllib3 response for requests to read the cookies."""
+
+    def __init__(self, headers):
+        self._original_response = self
+        self.msg = http.client.HTTPMessage()
+        for key, value in headers.multi_items():
+            self.msg[key] = value
+
+
+class HTTP2Adapter(BaseAdapter):
+    """
+    requests adapter that sends the requests through httpx, which can use
+    HTTP/2 to multiplex all of them over a single connection. Proxies,
+    client certificates and custom certificate verification are not
+    supported, and the requests asking for them fail -- use the default
+    backend for those, Tor included.
+    """
+
+    def __init__(self, pool_maxsize: int = settings.POOL_MAXSIZE):
+        if not httpx:
+            raise ImportError(
+                "You need the httpx library (pip install httpx[http2]) to use HTTP/2."
+            )
+        super().__init__()
+        self.pool_maxsize = pool_maxsize
+        self.client = self._new_client(pool_maxsize)
+
+    @staticmethod
+    def _new_client(pool_maxsize: int) -> "httpx.Client":
+        return httpx.Client(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=pool_maxsize,
+                max_keepalive_connections=pool_maxsize,
+            ),
+        )
+
+    def resize(self, pool_maxsize: int):
+        self.pool_maxsize = pool_maxsize
+        old_client, self.client = self.client, self._new_client(pool_maxsize)
+        old_client.close()
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        if select_proxy(request.url, proxies):
+            raise NotImplementedError(
+                "The http2 backend does not support proxies. "
+                "Use the requests backend instead."
+            )
+        if verify is not True or cert:
+            raise NotImplementedError(
+                "The http2 backend always verifies the certificates with the "
+                "default CA bundle and sends no client certificate. "
+                "Use the requests backend instead."
+            )
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            timeout = httpx.Timeout(read, connect=connect)
+        try:
+            res = self.client.request(
+                request.method,
+                request.url,
+                headers=request.headers,
+                content=request.body,
+                timeout=timeout,
+            )
+        except httpx.TransportError as exc:
+            raise requests.exceptions.ConnectionError(exc, request=request) from exc
+
+        response = requests.Response()
+        response.status_code = res.status_code
+        response.reason = res.reason_phrase
+        response.headers = CaseInsensitiveDict(res.headers)
+        response.encoding = res.encoding
+        response.url = str(res.url)
+        response.request = request
+        response.connection = self
+        response.raw = _CookieSource(res.headers)
+        response._content = res.content
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+BACKENDS = {
+    "requests": PooledAdapter,
+    "http2": HTTP2Adapter,
+}
+
+
+class Transport:
+    """
+    Connection pools by host, shared by every session using the transport.
+    Clients that target the same host reuse the same keep-alive connections.
+    """
+
+    def __init__(
+        self,
+        backend: str = settings.HTTP_BACKEND,
+        pool_maxsize: int = settings.POOL_MAXSIZE,
+    ):
+        self.backend = BACKENDS[backend]
+        self.pool_maxsize = pool_maxsize
+        self.adapters: Dict[str, BaseAdapter] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def adapter(self, url: str) -> BaseAdapter:
+        origin = self._origin(url)
+        with self._lock:
+            if origin not in self.adapters:
+                self.adapters[origin] = self.backend(self.pool_maxsize)
+            return self.adapters[origin]
+
+    def reserve(self, url: str, connections: int):
+        """Make sure the pool of the url's host holds at least that many
+        connections -- usually one per worker thread."""
+        adapter = self.adapter(url)
+        with self._lock:
+            if adapter.pool_maxsize < connections:
+                adapter.resize(connections)
+
+    def close(self):
+        with self._lock:
+            for adapter in self.adapters.values():
+                adapter.close()
+            self.adapters.clear()
+
+
+# shared by every session in the process
+transport = Transport()
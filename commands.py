@@ -1,9 +1,12 @@
 from getpass import getpass
+import hashlib
 import json
 import glob
 import os
+import uuid
+from collections import deque
 from pathlib import Path
-from typing import Union
+from typing import Deque, Dict, Optional, Tuple, Union
 
 try:
     import pytest
@@ -12,15 +15,19 @@ except ImportError:
 
 from aids.app.client import AIDScrapper, ClubClient, HoloClient, bs4
 import aids.to_html as to_html
-from aids.app.settings import BASE_DIR, secrets_form, DEBUG
-from aids.app.models import NAIScenario, Scenario
+from aids.app.settings import BASE_DIR, CONVERT_WORKERS, secrets_form, DEBUG
+from aids.app.models import NAIScenario, Scenario, Story
+from aids.app.database import ArchiveDatabase, SQLiteStorage
+from aids.app.manifest import Manifest, content_hash, file_state, same_file
+from aids.app.parallel import imap_bounded, worker_count
+from aids.app.storage import JSONStorage, JSONLinesStorage, read_objects
 
 
 command_arg_dict = {
     "Aid": {
-        "stories": ("title", "actions"),
-        "scenarios": ("title",),
-        "all": ("title", "actions"),
+        "stories": ("title", "actions", "incremental"),
+        "scenarios": ("title", "incremental"),
+        "all": ("title", "actions", "incremental"),
         "fenix": (),
     },
     "Club": {"publish": ("title",)},
@@ -34,25 +41,29 @@ class Aid(AIDScrapper):
         self.login()
         self.th = to_html.toHtml()
 
-    def stories(self, title, min_act):
+    def stories(self, title, min_act, incremental=False):
         self.adventures(title, min_act)
+        if incremental:
+            self.load_archive(self.adventures)
 
         self.get_stories()
 
         self.adventures.dump()
         self.th.story_to_html()
 
-    def scenarios(self, title):
+    def scenarios(self, title, incremental=False):
         self.prompts(title)
+        if incremental:
+            self.load_archive(self.prompts)
 
         self.get_scenarios()
 
         self.prompts.dump()
         self.th.scenario_to_html()
 
-    def all(self, title, min_act):
-        self.stories(title, min_act)
-        self.scenarios(title)
+    def all(self, title, min_act, incremental=False):
+        self.stories(title, min_act, incremental)
+        self.scenarios(title, incremental)
 
     def fenix(self):
         try:
@@ -85,12 +96,43 @@ class Club(ClubClient):
                     break
 
 
-def makejson(source_files: str = "*.scenario", target: str = ""):
-    data = _scenario_to_json(source_files)
-
+def makejson(
+    source_files: str = "*.scenario", target: str = "", workers: Optional[int] = None
+):
+    data = Scenario()
     if target:
         data.default_json_file = target
+    # the files converted by the previous run are kept if they did not change
+    output = data.storage.path
+    manifest = Manifest(output.with_name(output.name + ".manifest"))
+    if manifest.load(output):
+        data.load()
+
+    _scenario_to_json(source_files, data, manifest, workers)
+
     data.dump()
+    manifest.save(output)
+
+
+def migrate():
+    """Copy the stories and scenarios archives to SQLite databases."""
+    for model in (Story(), Scenario()):
+        name = model.__class__.__name__.lower()
+        sources = [
+            Path(name + backend.suffix)
+            for backend in (JSONStorage, JSONLinesStorage)
+            if Path(name + backend.suffix).exists()
+        ]
+        if not sources:
+            print(f"There is no {name} archive to migrate.")
+            continue
+        source, target = sources[0], Path(name + SQLiteStorage.suffix)
+        database = ArchiveDatabase(target)
+        try:
+            migrated = database.import_objects(model, read_objects(source))
+        finally:
+            database.close()
+        print(f"{migrated} objects copied from {source} to {target}")
 
 
 def _reformat_context(json_data):
@@ -114,86 +156,190 @@ def _reformat_context(json_data):
             json_data["authorsNote"] = json_data["context"][1]["text"]
 
 
-def _scenario_to_json(source_files: Union[str, Path]):
-    nai_file_name = glob.glob(str(source_files))
-    model = Scenario()
+def _read_nai_scenario(name: str) -> dict:
+    """The NAI scenario in the file, reformatted as an AID one. Run by the
+    processes of makejson."""
+    with open(name) as file:
+        json_data = json.load(file)
 
-    for name in nai_file_name:
+    _reformat_context(json_data)
 
-        with open(name) as file:
-            json_data = json.load(file)
+    # lorebook to worldInfo is way easier
+    json_data["worldInfo"] = [
+        {"keys": entry["keys"], "entry": entry["text"]}
+        for entry in json_data["lorebook"]["entries"]
+    ]
+    return json_data
 
-        _reformat_context(json_data)
 
-        # lorebook to worldInfo is way easier
-        json_data["worldInfo"] = [
-            {"keys": entry["keys"], "entry": entry["text"]}
-            for entry in json_data["lorebook"]["entries"]
-        ]
-        model.add(json_data.copy())
-
-        if DEBUG is False:
-            print("-------------------------------------")
-            print(
-                f'Your NAI scenario "{json_data["title"]}" was successfully '
-                "re-formatted."
-            )
-            print("-------------------------------------")
+def _scenario_to_json(
+    source_files: Union[str, Path],
+    model: Scenario,
+    manifest: Manifest,
+    workers: Optional[int] = None,
+) -> Scenario:
+    nai_file_name = glob.glob(str(source_files))
+    changed = [name for name in nai_file_name if not manifest.unchanged(name)]
+
+    # the scenarios of the files that changed or are gone are dropped, unless
+    # an unchanged file has the same title
+    kept = {
+        manifest.entries[name].get("title")
+        for name in set(nai_file_name) - set(changed)
+    }
+    for name in set(manifest.entries) - set(nai_file_name) | set(changed):
+        title = manifest.entries[name].get("title")
+        if title is not None and title not in kept:
+            model.pop(title, None)
+        if name not in nai_file_name:
+            del manifest.entries[name]
+
+    for name, json_data in zip(
+        changed,
+        imap_bounded(
+            _read_nai_scenario, changed, worker_count(workers, CONVERT_WORKERS)
+        ),
+    ):
+        model.add(json_data)
+        # written right away if the storage can do it cheaply
+        model.checkpoint()
+        manifest.entries[name]["title"] = json_data["title"]
+        _print_reformatted("NAI", json_data["title"])
     return model
 
 
 def makenai(
-    source_file: str = "scenario.json", target: str = "", single_files: bool = True
+    source_file: str = "scenario.json",
+    target: str = "",
+    single_files: bool = True,
+    workers: Optional[int] = None,
 ):
-    data = _json_to_scenario(source_file)
-
-    if target:
-        data.default_json_file = target
-        data.default_scenario_path = target
-    if single_files:
-        data.dump_single_files()
-    else:
+    if not single_files:
+        data = _json_to_scenario(source_file)
+        if target:
+            data.default_json_file = target
         data.dump()
+        return
+
+    # the scenarios are converted by a pool of processes and each one is
+    # written as soon as it is ready, without keeping them in memory. Those
+    # converted by a previous run, whose file is still there, are skipped.
+    directory = Path(target) if target else Path().cwd()
+    manifest = Manifest(directory / f"{Path(source_file).name}.makenai.manifest")
+    manifest.load()
+    identifier = str(uuid.uuid4())
+    seen = set()
+    # content hash of the scenarios sent to the pool, in order
+    pending: Deque[str] = deque()
+    # file name -> content hash of the scenario written to it
+    written: Dict[str, str] = {}
+
+    def changed_scenarios():
+        for scenario in read_objects(source_file):
+            digest = content_hash(scenario)
+            seen.add(digest)
+            entry = manifest.entries.get(digest)
+            if entry and (
+                entry["output"] is None
+                or same_file(
+                    directory / entry["output"],
+                    entry["output_state"],
+                    entry["output_hash"],
+                )
+            ):
+                continue
+            pending.append(digest)
+            yield scenario
+
+    for converted in imap_bounded(
+        _nai_scenario_file,
+        changed_scenarios(),
+        worker_count(workers, CONVERT_WORKERS),
+    ):
+        digest = pending.popleft()
+        if converted is None:
+            # not valid, and it will not be next time
+            manifest.entries[digest] = {"output": None}
+            continue
+        title, text = converted
+        name = f"{title}_{identifier}.scenario"
+        with open(directory / name, "w") as file:
+            file.write(text)
+        if name in written:
+            # a scenario with the same title, it is not there anymore
+            manifest.entries.pop(written[name], None)
+        written[name] = digest
+        manifest.entries[digest] = {
+            "output": name,
+            "output_state": file_state(directory / name),
+            "output_hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        }
+        _print_reformatted("AID", title)
+
+    # the files of the scenarios that are gone
+    for digest in set(manifest.entries) - seen:
+        output = manifest.entries.pop(digest)["output"]
+        if output is not None and output not in written:
+            try:
+                os.remove(directory / output)
+            except FileNotFoundError:
+                pass
+    manifest.save()
+
+
+def _print_reformatted(service: str, title: str):
+    if DEBUG is False:
+        print("-------------------------------------")
+        print(f'Your {service} scenario "{title}" was successfully re-formatted.')
+        print("-------------------------------------")
+
+
+def _to_nai(scenario: dict, scheme: dict) -> dict:
+    """The AID scenario in the NAI format. Built from the scheme's templates,
+    which are neither copied as a whole nor modified."""
+    memory_scheme, an_scheme = scheme["context"]
+    wi_entries_scheme = scheme["lorebook"]["entries"][0]
+    entries = [
+        {**wi_entries_scheme, "text": wi["entry"], "keys": wi["keys"]}
+        for wi in scenario.get("worldInfo") or ()
+    ]
+    return {
+        **scenario,
+        "context": [
+            {**memory_scheme, "text": scenario["memory"]},
+            {**an_scheme, "text": scenario["authorsNote"]},
+        ],
+        "lorebook": {"entries": entries},
+    }
+
+
+def _nai_scenario_file(scenario: dict) -> Optional[Tuple[str, str]]:
+    """Title and contents of the .scenario file of an AID scenario, None if
+    the scenario is not valid. Run by the processes of makenai."""
+    model = NAIScenario()
+    model.add(_to_nai(scenario, model.data))
+    for value in model.values():
+        # the key is the title before it was cleaned
+        return value["title"], json.dumps(value)
+    return None
 
 
 def _json_to_scenario(source_file: Union[str, Path]) -> "NAIScenario":
     model = NAIScenario()
 
-    data_scheme = model.data.copy()
-    an_scheme = data_scheme["context"].pop()
-    memory_scheme = data_scheme["context"].pop()
-    wi_entries_scheme = data_scheme["lorebook"]["entries"].pop()
-
-    with open(source_file) as file:
-        json_data = json.load(file)
+    for scenario in read_objects(source_file):
+        model.add(_to_nai(scenario, model.data))
+        _print_reformatted("AID", scenario["title"])
 
-    for scenario in json_data:
-        data_scheme.update(scenario)
-        if "worldInfo" in scenario and scenario["worldInfo"]:
-            entries = []
-            for wi in scenario["worldInfo"]:
-                wi_entries_scheme.update({"text": wi["entry"], "keys": wi["keys"]})
-                entries.append(wi_entries_scheme.copy())
-
-        an_scheme.update({"text": scenario["authorsNote"]})
-        memory_scheme.update({"text": scenario["memory"]})
+    return model
 
-        data_scheme.update(
-            {
-                "context": [memory_scheme.copy(), an_scheme.copy()],
-                "lorebook": {"entries": entries.copy()},
-            }
-        )
-        model.add(data_scheme.copy())
-        if DEBUG is False:
-            print("-------------------------------------")
-            print(
-                f'Your AID scenario "{scenario["title"]}" was successfully '
-                "re-formatted."
-            )
-            print("-------------------------------------")
 
-    return model
+def compiletemplates():
+    directory = to_html.compile_templates()
+    print(
+        f"Templates compiled to {directory}. Set PRECOMPILED_TEMPLATES to True "
+        "in the settings to use them."
+    )
 
 
 def test():
@@ -221,9 +367,14 @@ def register():
 
 
 def alltohtml(
-    file_dir: Union[str, Path] = "", story_outfile: str = "", scenario_outfile: str = ""
+    file_dir: Union[str, Path] = "",
+    story_outfile: str = "",
+    scenario_outfile: str = "",
+    workers: Optional[int] = None,
 ):
     th = to_html.toHtml()
+    if workers:
+        th.workers = workers
     if file_dir:
         th.out_path = file_dir
     if story_outfile:
@@ -1,4 +1,5 @@
 import sys
+import inspect
 from typing import List
 import argparse
 
@@ -19,6 +20,19 @@ def get_command(argv: List[str] = sys.argv[1:]):
     parser.add_argument(
         "-p", "--platform", type=str, help="platform where the client should point to"
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=0,
+        help="objects downloaded (or converted) at the same time",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="only download what changed since the last run",
+    )
 
     cmd = parser.parse_args(argv)
 
@@ -29,7 +43,12 @@ def get_command(argv: List[str] = sys.argv[1:]):
         try:
             args = command_arg_dict[cmd.platform][cmd.command]
             required_args = [
-                {"title": cmd.title, "actions": cmd.actions}.get(arg) for arg in args
+                {
+                    "title": cmd.title,
+                    "actions": cmd.actions,
+                    "incremental": cmd.incremental,
+                }.get(arg)
+                for arg in args
             ]
 
         except KeyError:
@@ -40,6 +59,8 @@ def get_command(argv: List[str] = sys.argv[1:]):
             # initialized in site
             platform = getattr(commands, cmd.platform)()
             command = getattr(platform, cmd.command)
+            if cmd.workers:
+                platform.workers = cmd.workers
         except AttributeError:
             print(
                 "Unrecognized command. Are you using a command meant for other platform?"
@@ -56,7 +77,11 @@ def get_command(argv: List[str] = sys.argv[1:]):
             )
         else:
             # to the date, all other commands do not require args
-            main_command()
+            # but the converters can be told how many processes to use
+            if cmd.workers and "workers" in inspect.signature(main_command).parameters:
+                main_command(workers=cmd.workers)
+            else:
+                main_command()
 
 
 if __name__ == "__main__":
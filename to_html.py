@@ -1,19 +1,206 @@
 import os
-import json
+import shutil
 from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader
 
-from aids.app.settings import BASE_DIR
+from aids.app.settings import (
+    BASE_DIR,
+    STORAGE_BACKEND,
+    HTML_INCREMENTAL,
+    HTML_WORKERS,
+    HTML_BATCH_SIZE,
+    TEMPLATE_CACHE_DIR,
+    PRECOMPILED_TEMPLATES,
+    COMPILED_TEMPLATES_DIR,
+    ImproperlyConfigured,
+)
+from aids.app.storage import STORAGE_BACKENDS, read_objects
+from aids.app.manifest import Manifest, content_hash, file_state
+from aids.app.parallel import imap_bounded, worker_count
+
+TEMPLATES_DIR = BASE_DIR / "templates"
+STATIC_FILES = (BASE_DIR / "static/style.css",)
+
+# the environment of the process, see environment()
+_environment = None
+
+
+def environment() -> Environment:
+    """The Jinja environment of the process. It is built once and keeps the
+    templates it loaded, without checking whether their files changed: they
+    are read (or their cached bytecode is) once per process."""
+    global _environment
+    if _environment is None:
+        if PRECOMPILED_TEMPLATES:
+            if not COMPILED_TEMPLATES_DIR.exists():
+                raise ImproperlyConfigured(
+                    f"There are no precompiled templates in {COMPILED_TEMPLATES_DIR}. "
+                    "Run the compiletemplates command first."
+                )
+            loader = ModuleLoader(str(COMPILED_TEMPLATES_DIR))
+        else:
+            loader = FileSystemLoader(TEMPLATES_DIR)
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+        _environment = Environment(
+            loader=loader,
+            bytecode_cache=FileSystemBytecodeCache(str(TEMPLATE_CACHE_DIR)),
+            auto_reload=False,
+        )
+    return _environment
+
+
+def compile_templates() -> Path:
+    """Compile the templates to Python modules in COMPILED_TEMPLATES_DIR, to
+    be used with PRECOMPILED_TEMPLATES."""
+    if COMPILED_TEMPLATES_DIR.exists():
+        shutil.rmtree(COMPILED_TEMPLATES_DIR)
+    Environment(loader=FileSystemLoader(TEMPLATES_DIR)).compile_templates(
+        str(COMPILED_TEMPLATES_DIR), zip=None
+    )
+    return COMPILED_TEMPLATES_DIR
+
+
+def plan_story_pages(stories: Iterable[Dict[str, Any]]) -> List[Tuple[str, Dict]]:
+    """The page of every story -- its path and what it is rendered with. The
+    stories with the same title are numbered: title.html, title2.html..."""
+    pages = []
+    planned = set()
+    story_number = {}
+    for story in stories:
+        if story["title"]:
+            story["title"] = story["title"].replace("/", "-")
+        if story["title"] not in story_number:
+            # new story
+            story_number = {story["title"]: ""}
+        if f'{story["title"]}{story_number[story["title"]]}' not in planned:
+            name = story["title"]
+        else:
+            # story from same scenario
+            if story_number[story["title"]]:
+                story_number[story["title"]] += 1
+            else:
+                story_number[story["title"]] = 2
+            name = f'{story["title"]}{story_number[story["title"]]}'
+        planned.add(name)
+        pages.append(
+            (
+                f"stories/{name}.html",
+                {
+                    "story": story,
+                    "story_number": {story["title"]: story_number[story["title"]]},
+                },
+            )
+        )
+    return pages
+
+
+def _index_entries(objects: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # what index.html shows of each object, the rest would only be hashed
+    return [
+        {key: obj[key] for key in ("title", "createdAt") if key in obj}
+        for obj in objects
+    ]
+
+
+def _render(
+    env: Environment,
+    out_path: Path,
+    templates: Dict[str, Any],
+    incremental: bool,
+    page: Tuple[str, str, Dict[str, Any], Optional[Dict[str, Any]]],
+) -> Optional[Dict[str, Any]]:
+    """Write a page -- (template, path, context, manifest entry) -- unless it
+    is unchanged. Its new manifest entry, None if it was not written."""
+    template, path, context, entry = page
+    digest = content_hash(
+        {"templates": templates, "template": template, "context": context}
+    )
+    output = out_path / path
+    if (
+        incremental
+        and entry
+        and entry["hash"] == digest
+        and entry["state"] == file_state(output)
+    ):
+        return None
+    with open(output, "w", encoding="utf-8") as file:
+        file.write(env.get_template(template).render(context))
+    return {"hash": digest, "state": file_state(output)}
+
+
+def _render_batch(batch) -> List[Tuple[str, Optional[Dict[str, Any]]]]:
+    """Write a batch of pages, see _render. Run by the processes of toHtml."""
+    out_path, templates, incremental, pages = batch
+    env = environment()
+    return [
+        (page[1], _render(env, out_path, templates, incremental, page))
+        for page in pages
+    ]
 
 
 class toHtml:
     def __init__(self):
-        self.env = Environment(loader=FileSystemLoader(BASE_DIR / "templates"))
+        self.env = environment()
 
         self.out_path = Path().cwd()
-        self.scen_out_file = "scenario.json"
-        self.story_out_file = "story.json"
+        suffix = STORAGE_BACKENDS[STORAGE_BACKEND].suffix
+        self.scen_out_file = f"scenario{suffix}"
+        self.story_out_file = f"story{suffix}"
+        # only render the pages whose story, scenario or templates changed
+        # since the last build, see html.manifest in out_path
+        self.incremental = HTML_INCREMENTAL
+        # processes rendering the stories, None for one per core -- whatever
+        # CONVERT_WORKERS is
+        self.workers = HTML_WORKERS
+        self._manifest = None
+        self._pages = set()
+        self._copied = set()
+
+    # --- incremental builds ---
+    def _templates_state(self) -> Dict[str, Any]:
+        directory = COMPILED_TEMPLATES_DIR if PRECOMPILED_TEMPLATES else TEMPLATES_DIR
+        return {
+            name: file_state(directory / name) for name in sorted(os.listdir(directory))
+        }
+
+    def _start_build(self):
+        # read even when not incremental, to keep the other pages' entries
+        self._manifest = Manifest(Path(self.out_path) / "html.manifest")
+        self._manifest.load()
+        self._templates = self._templates_state()
+        self._pages = set()
+
+    def _finish_build(self, prefixes: Tuple[str, ...]):
+        """Remove the pages of the last build that are not there anymore and
+        save the manifest."""
+        for path in list(self._manifest.entries):
+            if path.startswith(prefixes) and path not in self._pages:
+                del self._manifest.entries[path]
+                try:
+                    os.remove(Path(self.out_path) / path)
+                except FileNotFoundError:
+                    pass
+        self._manifest.save()
+
+    def write_page(self, template: str, path: str, context: Dict[str, Any]) -> bool:
+        """Render the template to out_path/path. In incremental builds, only if
+        the page is not already there, rendered with the same context and
+        templates. Whether the page was written."""
+        path = Path(path).as_posix()
+        self._pages.add(path)
+        entry = _render(
+            self.env,
+            Path(self.out_path),
+            self._templates,
+            self.incremental,
+            (template, path, context, self._manifest.entries.get(path)),
+        )
+        if entry is None:
+            return False
+        self._manifest.entries[path] = entry
+        return True
 
     def new_dir(self, folder):
         if folder:
@@ -21,70 +208,64 @@ class toHtml:
                 os.mkdir(self.out_path / folder)
             except FileExistsError:
                 pass
-        with open(BASE_DIR / "static/style.css", "r") as file:
-            style = file.read()
-        with open(self.out_path / f"{folder}/style.css", "w") as file:
-            file.write(style)
+        # the static files are copied once, and only if they changed
+        for source in STATIC_FILES:
+            target = Path(self.out_path) / folder / source.name
+            if target in self._copied:
+                continue
+            state = file_state(target)
+            if state is None or state != file_state(source):
+                shutil.copy2(source, target)
+            self._copied.add(target)
 
     def story_to_html(self, infile: str = None):
         infile = infile or self.out_path / self.story_out_file
 
         self.new_dir("stories")
-        with open(infile) as file:
-            stories = json.load(file)
-
-        story_templ = self.env.get_template("story.html")
-        story_number = {}
-        for story in reversed(stories):
-            if story["title"]:
-                story["title"] = story["title"].replace("/", "-")
-            try:
-                story_number[story["title"]]
-            except KeyError:
-                # new story
-                story_number = {story["title"]: ""}
-            if not os.path.exists(
-                self.out_path
-                / f'stories/{story["title"]}{story_number[story["title"]]}.html'
-            ):
-                htmlfile = open(
-                    self.out_path / f'stories/{story["title"]}.html',
-                    "w",
-                    encoding="utf-8",
-                )
-            else:
-                # story from same scenario
-                if story_number[story["title"]]:
-                    story_number[story["title"]] += 1
-                    htmlfile = open(
-                        self.out_path
-                        / f'stories/{story["title"]}{story_number[story["title"]]}.html',
-                        "w",
-                        encoding="utf-8",
-                    )
-                else:
-                    story_number[story["title"]] = 2
-                    htmlfile = open(
-                        self.out_path
-                        / f'stories/{story["title"]}{story_number[story["title"]]}.html',
-                        "w",
-                        encoding="utf-8",
-                    )
-            htmlfile.write(
-                story_templ.render({"story": story, "story_number": story_number})
+        stories = list(read_objects(infile))
+
+        self._start_build()
+        # the pages are rendered and written by `workers` processes, some at a
+        # time. Their paths were planned beforehand: the same files are
+        # written whatever the number of workers. A page planned twice is
+        # written once, with the last story, as it would be one at a time.
+        pages = {}
+        for path, context in plan_story_pages(reversed(stories)):
+            path = Path(path).as_posix()
+            entry = self._manifest.entries.get(path)
+            pages[path] = ("story.html", path, context, entry)
+        pages = list(pages.values())
+        batches = (
+            (
+                Path(self.out_path),
+                self._templates,
+                self.incremental,
+                pages[start : start + HTML_BATCH_SIZE],
             )
-            htmlfile.close()
-        index = self.env.get_template("index.html")
-        with open(self.out_path / "story_index.html", "w") as outfile:
-            outfile.write(index.render({"objects": stories, "content_type": "stories"}))
-        print("Stories successfully formatted")
+            for start in range(0, len(pages), HTML_BATCH_SIZE)
+        )
+        written = 0
+        for results in imap_bounded(_render_batch, batches, worker_count(self.workers)):
+            for path, entry in results:
+                self._pages.add(path)
+                if entry is not None:
+                    self._manifest.entries[path] = entry
+                    written += 1
+        self.write_page(
+            "index.html",
+            "story_index.html",
+            {"objects": _index_entries(stories), "content_type": "stories"},
+        )
+        self._finish_build(("stories/", "story_index.html"))
+        print(f"Stories successfully formatted ({written} pages written)")
 
     def scenario_to_html(self, infile: str = None):
         infile = infile or self.out_path / self.scen_out_file
         self.new_dir("scenarios")
-        with open(infile) as file:
-            scenarios = json.load(file)
+        scenarios = list(read_objects(infile))
 
+        self._start_build()
+        written = 0
         subscen_paths = {}
         parent_scen = []
         for scenario in reversed(scenarios):
@@ -92,28 +273,16 @@ class toHtml:
             if "isOption" not in scenario or not scenario["isOption"]:
                 # base scenario, initializing the path
                 scenario["path"] = "scenarios/"
-                with open(
-                    self.out_path / f'{scenario["path"] + scenario["title"]}.html', "w"
-                ) as file:
-                    scen_templ = self.env.get_template("scenario.html")
-                    file.write(
-                        scen_templ.render(
-                            {"scenario": scenario, "content_type": "scenario"}
-                        )
-                    )
+                path = f'{scenario["path"] + scenario["title"]}.html'
                 parent_scen.append(scenario)
             else:
                 scenario["path"] = subscen_paths[scenario["title"]]
-
-                with open(
-                    self.out_path / f'{scenario["path"]}/{scenario["title"]}.html', "w"
-                ) as file:
-                    scen_templ = self.env.get_template("scenario.html")
-                    file.write(
-                        scen_templ.render(
-                            {"scenario": scenario, "content_type": "scenario"}
-                        )
-                    )
+                path = f'{scenario["path"]}/{scenario["title"]}.html'
+            written += self.write_page(
+                "scenario.html",
+                path,
+                {"scenario": scenario, "content_type": "scenario"},
+            )
             if "options" in scenario and any(scenario["options"]):
                 for subscen in scenario["options"]:
                     if subscen and "title" in subscen:
@@ -122,9 +291,10 @@ class toHtml:
                         subscen_paths[subscen["title"]] = subscen["path"] + "/"
                         self.new_dir(subscen["path"])
 
-        index = self.env.get_template("index.html")
-        with open(self.out_path / "scen_index.html", "w") as outfile:
-            outfile.write(
-                index.render({"objects": parent_scen, "content_type": "scenarios"})
-            )
-        print("Scenarios successfully formatted")
+        self.write_page(
+            "index.html",
+            "scen_index.html",
+            {"objects": _index_entries(parent_scen), "content_type": "scenarios"},
+        )
+        self._finish_build(("scenarios/", "scen_index.html"))
+        print(f"Scenarios successfully formatted ({written} pages written)")